@@ -0,0 +1,60 @@
+"""Measure concurrent write throughput with and without group commit.
+
+This adds notes from many concurrent tasks to a temporary database, once
+committing each write alone and once with the default batch size:
+
+.. code-block:: bash
+
+    python benchmark/group_commit.py --writes 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from noteandtag import monad
+
+
+async def run(db_path, writes, concurrency, batch_size):
+    db = monad.AsyncDatabase(db_path, commit_batch_size=batch_size)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def add_note(i):
+        async with semaphore:
+            await db.add_note(
+                {"label": f"note {i}", "author": "benchmark", "body": "", "tags": ["a"]}
+            )
+
+    start = time.perf_counter()
+    await asyncio.gather(*[add_note(i) for i in range(writes)])
+    elapsed = time.perf_counter() - start
+    db.close()
+    return writes / elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes", type=int, default=2000, help="number of notes")
+    parser.add_argument("--concurrency", type=int, default=50, help="pending writes")
+    args = parser.parse_args(argv)
+
+    print(f"{'batch size':<12} {'writes/s':>10}")
+    for batch_size in (1, monad.COMMIT_BATCH_SIZE):
+        with tempfile.TemporaryDirectory() as tmp:
+            rate = asyncio.get_event_loop().run_until_complete(
+                run(
+                    os.path.join(tmp, "db.sqlite3"),
+                    args.writes,
+                    args.concurrency,
+                    batch_size,
+                )
+            )
+        print(f"{batch_size:<12} {rate:>10,.0f}")
+
+
+if __name__ == "__main__":
+    main()
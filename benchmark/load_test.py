@@ -0,0 +1,424 @@
+"""Load test the service on synthetic datasets.
+
+This generates databases of notes with a realistic distribution of tags,
+serves each one from a separate process, and sends concurrent requests
+for each endpoint and filter combination:
+
+.. code-block:: bash
+
+    python benchmark/load_test.py --sizes 1000,100000 --duration 10
+
+Throughput and p50/p95/p99 latencies are printed and saved to a JSON file,
+which can be compared against a previous run:
+
+.. code-block:: bash
+
+    python benchmark/load_test.py --compare load_test-20240101-120000.json
+
+Generated datasets are cached in `--data-dir`, as the 1M notes one takes
+a while. Each run works on a copy so that writes don't alter them.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT_DIR)
+
+import aiohttp
+from aiohttp import web
+from noteandtag import monad, Application
+
+DEFAULT_SIZES = "1000,100000,1000000"
+# Number of distinct tags, words and authors in datasets
+TAGS = 2000
+WORDS = 5000
+AUTHORS = 50
+# Skew of tag and word popularity, as in a Zipf distribution
+ZIPF_EXPONENT = 1.1
+# Number of notes per transaction when generating datasets
+BATCH_SIZE = 10000
+SEED = 42
+
+
+def zipf_weights(n):
+    weights = [1 / (rank**ZIPF_EXPONENT) for rank in range(1, n + 1)]
+    return list(itertools.accumulate(weights))
+
+
+def vocabulary(rng, n):
+    syllables = ["ka", "lo", "mi", "ne", "tu", "ra", "si", "po", "de", "va", "gu", "ze"]
+    words = set()
+    while len(words) < n:
+        words.add("".join(rng.choices(syllables, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+def generate_notes(size, rng):
+    """Generate notes whose words and tags follow a Zipf distribution."""
+    words = vocabulary(rng, WORDS)
+    word_weights = zipf_weights(WORDS)
+    tags = [f"tag{i}" for i in range(TAGS)]
+    tag_weights = zipf_weights(TAGS)
+    authors = [f"author{i}" for i in range(AUTHORS)]
+
+    for _ in range(size):
+        yield {
+            "label": " ".join(
+                rng.choices(words, cum_weights=word_weights, k=rng.randint(2, 6))
+            ),
+            "author": rng.choice(authors),
+            "body": " ".join(
+                rng.choices(words, cum_weights=word_weights, k=rng.randint(20, 80))
+            ),
+            "tags": list(
+                set(rng.choices(tags, cum_weights=tag_weights, k=rng.randint(1, 5)))
+            ),
+        }
+
+
+def generate_dataset(path, size):
+    tmp = path + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    db = monad.Database(tmp)
+    rng = random.Random(SEED)
+    notes = generate_notes(size, rng)
+    done = 0
+    start = time.perf_counter()
+    while done < size:
+        done += db.import_notes(list(itertools.islice(notes, BATCH_SIZE)))
+        print(f"  {done}/{size} notes", end="\r", file=sys.stderr)
+    db.close()
+    print(
+        f"  {size} notes generated in {time.perf_counter() - start:.0f}s",
+        file=sys.stderr,
+    )
+
+    # Merge the WAL so that copying the file is enough
+    conn = sqlite3.connect(tmp)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.close()
+    os.replace(tmp, path)
+
+
+def dataset_info(path):
+    """Get the values scenarios pick from: ids, popular and rare tags, words."""
+    conn = sqlite3.connect(path)
+    try:
+        max_id = conn.execute("SELECT MAX(id) FROM note").fetchone()[0]
+        tags = [
+            _[0]
+            for _ in conn.execute("SELECT label FROM tag ORDER BY total DESC, label")
+        ]
+        label = conn.execute("SELECT label FROM note WHERE id=1").fetchone()[0]
+    finally:
+        conn.close()
+
+    return {
+        "max_id": max_id,
+        "popular_tag": tags[0],
+        "second_tag": tags[1],
+        "rare_tag": tags[-1],
+        "word": label.split()[0],
+    }
+
+
+def scenarios(info, size):
+    """Get (name, method, function returning path, params and body)."""
+    api = "/api/v1/"
+
+    def get(path, **params):
+        return lambda rng: (path, params, None)
+
+    def note_by_id(rng):
+        return f"{api}notes/{rng.randint(1, info['max_id'])}", {}, None
+
+    def put_note(rng):
+        data = {
+            "label": "load test",
+            "author": "benchmark",
+            "body": "",
+            "tags": [info["popular_tag"]],
+        }
+        return f"{api}notes", {}, json.dumps({"data": data})
+
+    return [
+        ("index", "GET", get("/")),
+        ("notes", "GET", get(api + "notes")),
+        ("notes offset", "GET", get(api + "notes", offset=size // 2)),
+        ("notes sortBy label", "GET", get(api + "notes", sortBy="label:desc")),
+        ("notes popular tag", "GET", get(api + "notes", tags=info["popular_tag"])),
+        ("notes rare tag", "GET", get(api + "notes", tags=info["rare_tag"])),
+        (
+            "notes two tags",
+            "GET",
+            get(api + "notes", tags=f"{info['popular_tag']},{info['second_tag']}"),
+        ),
+        ("notes label search", "GET", get(api + "notes", label=info["word"])),
+        (
+            "notes body search rank",
+            "GET",
+            get(api + "notes", body=info["word"], sortBy="rank"),
+        ),
+        ("notes stream 1000", "GET", get(api + "notes", stream="true", limit=1000)),
+        ("note by id", "GET", note_by_id),
+        ("tags", "GET", get(api + "tags")),
+        ("tags sortBy total", "GET", get(api + "tags", sortBy="total:desc")),
+        ("add note", "PUT", put_note),
+    ]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve(db_path, port):
+    app = Application(
+        db=db_path,
+        jinja2_templates_dir=os.path.join(ROOT_DIR, "etc", "templates"),
+        cdn_url="/static",
+        static_dir=os.path.join(ROOT_DIR, "static"),
+        default_theme="monokaiorange",
+        api_base_url="/api/v1/",
+    )
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+async def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(url + "/api/v1/tags") as resp:
+                    await resp.read()
+                    return
+            except aiohttp.ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+async def run_scenario(session, url, method, request, *, concurrency, duration, warmup):
+    rng = random.Random(SEED)
+    latencies = []
+    errors = 0
+
+    async def send():
+        path, params, body = request(rng)
+        start = time.perf_counter()
+        async with session.request(
+            method, url + path, params=params, data=body
+        ) as resp:
+            await resp.read()
+            return resp.status, time.perf_counter() - start
+
+    for _ in range(warmup):
+        await send()
+
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            status, latency = await send()
+            if status >= 400:
+                errors += 1
+            latencies.append(latency)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+    }
+
+
+async def run_dataset(db_path, size, args):
+    info = dataset_info(db_path)
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = multiprocessing.get_context("fork").Process(
+        target=serve, args=(db_path, port), daemon=True
+    )
+    server.start()
+    results = []
+    try:
+        await wait_for_server(url)
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            for name, method, request in scenarios(info, size):
+                if args.scenarios and name not in args.scenarios:
+                    continue
+
+                result = await run_scenario(
+                    session,
+                    url,
+                    method,
+                    request,
+                    concurrency=args.concurrency,
+                    duration=args.duration,
+                    warmup=args.warmup,
+                )
+                result.update({"dataset": size, "scenario": name})
+                results.append(result)
+                print_result(result)
+    finally:
+        server.terminate()
+        server.join()
+
+    return results
+
+
+def print_header():
+    print(
+        f"{'dataset':>8} {'scenario':<24} {'req/s':>9} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+
+
+def print_result(result):
+    print(
+        "{dataset:>8} {scenario:<24} {rps:>9.1f} {p50_ms:>8.2f} "
+        "{p95_ms:>8.2f} {p99_ms:>8.2f} {errors:>7}".format(**result)
+    )
+
+
+def print_comparison(results, previous):
+    """Print changes of throughput and p95 latency since a previous run."""
+    before = {(_["dataset"], _["scenario"]): _ for _ in previous["results"]}
+    print(f"\n{'dataset':>8} {'scenario':<24} {'req/s':>9} {'p95 ms':>9}")
+    for result in results:
+        old = before.get((result["dataset"], result["scenario"]), None)
+        if old is None:
+            continue
+        print(
+            "{:>8} {:<24} {:>+8.0%} {:>+9.0%}".format(
+                result["dataset"],
+                result["scenario"],
+                result["rps"] / old["rps"] - 1,
+                result["p95_ms"] / old["p95_ms"] - 1,
+            )
+        )
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "HEAD"],
+                cwd=ROOT_DIR,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                check=True,
+            )
+            .stdout.decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", default=DEFAULT_SIZES, help="comma-separated numbers of notes"
+    )
+    parser.add_argument("--concurrency", type=int, default=16, help="pending requests")
+    parser.add_argument(
+        "--duration", type=float, default=5, help="seconds per scenario"
+    )
+    parser.add_argument("--warmup", type=int, default=20, help="requests per scenario")
+    parser.add_argument(
+        "--scenario",
+        dest="scenarios",
+        action="append",
+        help="only run this scenario, can be repeated",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "noteandtag-benchmark"),
+        help="directory caching generated datasets",
+    )
+    parser.add_argument(
+        "--output",
+        default=time.strftime("load_test-%Y%m%d-%H%M%S.json"),
+        help="file to save results to",
+    )
+    parser.add_argument("--compare", help="results of a previous run")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    sizes = [int(_) for _ in args.sizes.split(",")]
+    results = []
+    print_header()
+    for size in sizes:
+        dataset = os.path.join(args.data_dir, f"notes-{size}.sqlite3")
+        if not os.path.exists(dataset):
+            print(f"Generating {size} notes to {dataset}", file=sys.stderr)
+            generate_dataset(dataset, size)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "db.sqlite3")
+            shutil.copyfile(dataset, db_path)
+            results.extend(
+                asyncio.get_event_loop().run_until_complete(
+                    run_dataset(db_path, size, args)
+                )
+            )
+
+    output = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults saved to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
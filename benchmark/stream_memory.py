@@ -0,0 +1,136 @@
+"""Compare peak memory of buffered and streamed responses.
+
+This fills a temporary database, then requests all notes in a single page,
+once buffered in memory and once streamed with **stream=true**. Each mode
+runs in its own process so that peak RSS are not mixed:
+
+.. code-block:: bash
+
+    python benchmark/stream_memory.py --rows 10000
+
+Buffered mode is run with the max limit raised to the number of rows, as
+the API would otherwise reject such a page.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT_DIR)
+
+from aiohttp.test_utils import TestClient, TestServer
+from noteandtag import monad, Application
+
+MODES = ("buffered", "stream")
+
+
+def populate(db_path, rows, body_size):
+    db = monad.Database(db_path)
+    db.import_notes(
+        {
+            "label": f"note {i}",
+            "author": "benchmark",
+            "body": "x" * body_size,
+            "tags": [f"tag{i % 100}", "benchmark"],
+        }
+        for i in range(rows)
+    )
+    db.close()
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+async def measure(mode, db_path, rows):
+    if mode == "buffered":
+        monad.MAX_LIMIT = rows
+
+    app = Application(
+        db=db_path,
+        jinja2_templates_dir=os.path.join(ROOT_DIR, "etc", "templates"),
+        cdn_url="/static",
+        default_theme="default",
+        api_base_url="/api/v1/",
+    )
+    async with TestClient(TestServer(app)) as client:
+        params = {"limit": rows}
+        if mode == "stream":
+            params["stream"] = "true"
+
+        # Warm up so that baseline includes imported modules and caches
+        resp = await client.get("/api/v1/notes", params={**params, "limit": 1})
+        await resp.read()
+
+        baseline = peak_rss_kb()
+        resp = await client.get("/api/v1/notes", params=params)
+        assert resp.status == 200, resp.status
+        size = 0
+        async for chunk in resp.content.iter_chunked(65536):
+            size += len(chunk)
+
+        return {
+            "mode": mode,
+            "rows": rows,
+            "bytes": size,
+            "baseline_kb": baseline,
+            "peak_kb": peak_rss_kb(),
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="number of notes")
+    parser.add_argument("--body-size", type=int, default=1000, help="note size")
+    parser.add_argument("--run", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # Child process measuring a single mode
+    if args.run:
+        result = asyncio.get_event_loop().run_until_complete(
+            measure(args.run, args.db, args.rows)
+        )
+        print(json.dumps(result))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.sqlite3")
+        populate(db_path, args.rows, args.body_size)
+
+        print(f"{'mode':<10} {'rows':>8} {'response':>12} {'peak RSS delta':>16}")
+        for mode in MODES:
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--run",
+                    mode,
+                    "--db",
+                    db_path,
+                    "--rows",
+                    str(args.rows),
+                ],
+                check=True,
+                stdout=subprocess.PIPE,
+            ).stdout
+            result = json.loads(output)
+            print(
+                "{:<10} {:>8} {:>10} KB {:>13} KB".format(
+                    result["mode"],
+                    result["rows"],
+                    result["bytes"] // 1024,
+                    result["peak_kb"] - result["baseline_kb"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,14 @@ import argparse
 import json
 from aiohttp import web
 import logging
-from noteandtag.app import Application
-from noteandtag import configuration
+from noteandtag.app import (
+    Application,
+    EXPORT_BATCH_SIZE,
+    IMPORT_BATCH_SIZE,
+    assets,
+    encoder,
+)
+from noteandtag import configuration, logqueue, monad, prefork, slowlog
 
 
 def setup_logging(
@@ -14,38 +20,76 @@ def setup_logging(
     access_logfile=None,
     access_maxbytes=None,
     access_backupcount=None,
+    access_sample_rate=None,
     error_logfile=None,
     error_maxbytes=None,
-    error_backupcount=None
+    error_backupcount=None,
+    slow_query_logfile=None,
+    queue_size=None,
+    drop_policy=None,
 ):
     """Setup logging handlers.
 
     This setup two `RotatingFileHandler` for `aiohttp.access` and `aiohttp.server` logs.
+    Slow queries are logged to the same kind of handler, rotated like error logs.
+
+    Handlers, including those already set on the root logger, are run by
+    background threads fed by bounded queues so that they never block the
+    event loop.
 
     :param access_logfile: path for access logfile or `None`
     :param access_maxbytes: max bytes per access logfile
     :param access_backupcount: max number of access logfile to keep
+    :param access_sample_rate: fraction of successful requests to log
     :param error_logfile: path for error logfile or `None`
     :param error_maxbytes: max bytes per error logfile
     :param error_backupcount: max number of error logfile to keep
+    :param slow_query_logfile: path for slow-query logfile or `None`
+    :param queue_size: max number of records waiting to be written, per logger
+    :param drop_policy: `drop` new records or `block` when a queue is full
     """
     from logging.handlers import RotatingFileHandler
 
+    def attach(logger, handler):
+        logqueue.attach(
+            logger, [handler], queue_size=queue_size, drop_policy=drop_policy or "drop"
+        )
+
+    root = logging.getLogger()
+    handlers, root.handlers = root.handlers, []
+    for _ in handlers:
+        attach(root, _)
+
+    if access_sample_rate is not None and access_sample_rate < 1:
+        logging.getLogger("aiohttp.access").addFilter(
+            logqueue.SamplingFilter(access_sample_rate)
+        )
     if access_logfile:
-        logging.getLogger("aiohttp.access").addHandler(
+        attach(
+            logging.getLogger("aiohttp.access"),
             RotatingFileHandler(
                 access_logfile,
                 maxBytes=access_maxbytes,
                 backupCount=access_backupcount,
-            )
+            ),
         )
     if error_logfile:
-        logging.getLogger("aiohttp.server").addHandler(
+        attach(
+            logging.getLogger("aiohttp.server"),
             RotatingFileHandler(
                 error_logfile,
                 maxBytes=error_maxbytes,
                 backupCount=error_backupcount,
-            )
+            ),
+        )
+    if slow_query_logfile:
+        attach(
+            logging.getLogger(slowlog.logger.name),
+            RotatingFileHandler(
+                slow_query_logfile,
+                maxBytes=error_maxbytes,
+                backupCount=error_backupcount,
+            ),
         )
 
 
@@ -60,36 +104,215 @@ def run(
     swagger_url: str,
     api_base_url: str,
     base_url: str,
-    port: int
+    port: int,
+    metrics_url: str = None,
+    db_workers: int = None,
+    json_encoder: str = None,
+    workers: int = None,
+    assets_dir: str = None,
+    commit_interval: float = None,
+    commit_batch_size: int = None,
+    events_buffer_size: int = None
 ):
-    app = Application(
-        db=db,
-        jinja2_templates_dir=jinja2_templates_dir,
-        cdn_url=cdn_url,
-        static_dir=static_dir,
-        default_theme=default_theme,
-        swagger_yml=swagger_yml,
-        swagger_url=swagger_url,
-        api_base_url=api_base_url,
-        base_url=base_url,
+    """Run the server until interrupted.
+
+    With more than one worker, the server is forked into as many worker
+    processes sharing the same port and SQLite database.
+    """
+
+    def create_app(db_generation=None):
+        return Application(
+            db=db,
+            jinja2_templates_dir=jinja2_templates_dir,
+            cdn_url=cdn_url,
+            static_dir=static_dir,
+            assets_dir=assets_dir,
+            default_theme=default_theme,
+            swagger_yml=swagger_yml,
+            swagger_url=swagger_url,
+            api_base_url=api_base_url,
+            base_url=base_url,
+            metrics_url=metrics_url,
+            db_workers=db_workers,
+            json_encoder=json_encoder,
+            db_generation=db_generation,
+            commit_interval=commit_interval,
+            commit_batch_size=commit_batch_size,
+            events_buffer_size=events_buffer_size,
+        )
+
+    if not workers or workers <= 1:
+        web.run_app(create_app(), port=port)
+        return
+
+    # Migrate the schema once before forking, connections are not inherited
+    monad.Database(db).close()
+    generation = monad.Generation(shared=True, workers=workers)
+    prefork.serve(
+        lambda index: create_app(generation.worker(index)),
+        port=port,
+        workers=workers,
     )
-    web.run_app(app, port=port)
+
+
+def _load_config(config_dir):
+    if not os.path.isdir(config_dir):
+        raise NotADirectoryError(config_dir)
+
+    return configuration.load(os.path.join(config_dir, "config.cnf"))
+
+
+def import_notes(argv):
+    """Import notes from a NDJSON file, one note per line."""
+    parser = argparse.ArgumentParser(
+        prog="noteandtag import", description="Import notes from a NDJSON file"
+    )
+    parser.add_argument("directory", type=str, help="config directory")
+    parser.add_argument(
+        "file", type=str, nargs="?", default="-", help="input file, - for stdin"
+    )
+    args = parser.parse_args(args=argv)
+
+    config = _load_config(args.directory)
+    db = monad.Database(config["service"]["db"])
+
+    def import_batch(notes):
+        nonlocal total
+        total += db.import_notes(notes)
+        notes.clear()
+
+    f = sys.stdin if args.file == "-" else open(args.file, "r", encoding="utf-8")
+    try:
+        total = 0
+        notes = []
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+
+            # Batches already imported are kept, tell where to resume from
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                sys.exit(f"line {lineno}: {e}, {total} notes imported")
+            if not monad.is_valid_note(data):
+                sys.exit(f"line {lineno}: invalid note, {total} notes imported")
+
+            notes.append(data)
+            if len(notes) >= IMPORT_BATCH_SIZE:
+                import_batch(notes)
+        if notes:
+            import_batch(notes)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        db.close()
+
+    print(f"{total} notes imported", file=sys.stderr)
+
+
+def export_notes(argv):
+    """Export all notes to a NDJSON file, one note per line."""
+    parser = argparse.ArgumentParser(
+        prog="noteandtag export", description="Export notes to a NDJSON file"
+    )
+    parser.add_argument("directory", type=str, help="config directory")
+    parser.add_argument(
+        "file", type=str, nargs="?", default="-", help="output file, - for stdout"
+    )
+    args = parser.parse_args(args=argv)
+
+    config = _load_config(args.directory)
+    db = monad.Database(config["service"]["db"])
+
+    f = sys.stdout.buffer if args.file == "-" else open(args.file, "wb")
+    try:
+        after = 0
+        while True:
+            notes = db.export_notes(after=after, limit=EXPORT_BATCH_SIZE)
+            if not notes:
+                break
+
+            for _ in notes:
+                f.write(encoder.dumps(_) + b"\n")
+            after = notes[-1]["id"]
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+        db.close()
+
+
+def build_assets(argv):
+    """Build versioned and compressed static files."""
+    parser = argparse.ArgumentParser(
+        prog="noteandtag assets",
+        description="Build static files from static-dir to assets-dir",
+    )
+    parser.add_argument("directory", type=str, help="config directory")
+    args = parser.parse_args(args=argv)
+
+    config = _load_config(args.directory)
+    static_dir = config["service"].get("static-dir", None)
+    assets_dir = config["service"].get("assets-dir", None)
+    if not static_dir or not assets_dir:
+        parser.error("static-dir and assets-dir must be configured")
+
+    manifest = assets.build(static_dir, assets_dir)
+    print(f"{len(manifest)} files built to {assets_dir}", file=sys.stderr)
+
+
+def migrate_db(argv):
+    """Migrate DB to the last version of its schema."""
+    parser = argparse.ArgumentParser(
+        prog="noteandtag migrate",
+        description="Migrate DB to the last version of its schema",
+    )
+    parser.add_argument("directory", type=str, help="config directory")
+    parser.add_argument(
+        "--online",
+        action="store_true",
+        help="migrate rows by small transactions while the service is running",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=monad.BACKFILL_BATCH_SIZE,
+        help="number of rows per transaction when online",
+    )
+    args = parser.parse_args(args=argv)
+
+    config = _load_config(args.directory)
+    db = monad.Database(config["service"]["db"], migrate=False)
+    try:
+        version = db.migrate(online=args.online, batch_size=args.batch_size)
+    finally:
+        db.close()
+
+    print(f"database at version {version}", file=sys.stderr)
+
+
+COMMANDS = {
+    "import": import_notes,
+    "export": export_notes,
+    "assets": build_assets,
+    "migrate": migrate_db,
+}
 
 
 def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
     parser = argparse.ArgumentParser(
         prog="noteandtag",
         description="Website and REST API for taking notes and organizing by tags",
+        epilog="Run noteandtag {import,export,assets,migrate} --help for other commands",
     )
     parser.add_argument("directory", type=str, help="config directory")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbosity level")
     args = parser.parse_args(args=argv)
 
-    config_dir = args.directory
-    if not os.path.isdir(config_dir):
-        raise NotADirectoryError(config_dir)
-
-    config = configuration.load(os.path.join(config_dir, "config.cnf"))
+    config = _load_config(args.directory)
 
     logging.basicConfig(level=logging.INFO)
 
@@ -97,9 +320,20 @@ def main(argv=None):
         access_logfile=config["logging"].get("access-logfile", None),
         access_maxbytes=int(config["logging"].get("access-maxbytes", None)),
         access_backupcount=int(config["logging"].get("access-backupcount", None)),
+        access_sample_rate=float(config["logging"]["access-sample-rate"]),
         error_logfile=config["logging"].get("error-logfile", None),
         error_maxbytes=int(config["logging"].get("error-maxbytes", None)),
         error_backupcount=int(config["logging"].get("error-backupcount", None)),
+        slow_query_logfile=config["logging"].get("slow-query-logfile", None),
+        queue_size=int(config["logging"]["queue-size"]),
+        drop_policy=config["logging"]["drop-policy"],
+    )
+
+    threshold = config["logging"].get("slow-query-threshold", None)
+    slowlog.setup(
+        float(threshold) if threshold else None,
+        sample_rate=float(config["logging"]["slow-query-sample-rate"]),
+        rate_limit=int(config["logging"]["slow-query-rate-limit"]),
     )
 
     run(
@@ -107,12 +341,20 @@ def main(argv=None):
         jinja2_templates_dir=config["service"]["jinja2-templates-dir"],
         cdn_url=config["service"]["cdn-url"],
         static_dir=config["service"].get("static-dir", None),
+        assets_dir=config["service"].get("assets-dir", None),
         default_theme=config["service"]["default-theme"],
         swagger_yml=config["service"].get("swagger-yml", None),
         swagger_url=config["service"].get("swagger-url", None),
         api_base_url=config["service"]["api-base-url"],
         base_url=config["service"]["base-url"],
         port=int(config["service"]["port"]),
+        metrics_url=config["service"].get("metrics-url", None),
+        db_workers=int(config["service"]["db-workers"]),
+        json_encoder=config["service"]["json-encoder"],
+        workers=int(config["service"]["workers"]),
+        commit_interval=float(config["service"]["commit-interval"]),
+        commit_batch_size=int(config["service"]["commit-batch-size"]),
+        events_buffer_size=int(config["service"]["events-buffer-size"]),
     )
 
 
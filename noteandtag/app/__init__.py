@@ -1,32 +1,93 @@
+import hashlib
 import json
+import os
 import re
+import sqlite3
+import time
 from aiohttp import web
 import aiohttp_cors
 import aiohttp_swagger
 import aiohttp_jinja2
 import jinja2
-from functools import wraps
-from typing import Callable, Any, List
-from noteandtag import monad
-from noteandtag.app import validator
+from functools import wraps, partial
+from typing import Callable, Any, Dict, List, Optional, Set
+from noteandtag import metrics, monad
+from noteandtag.feed import ChangeFeed
+from noteandtag.app import assets, encoder, error, validator
 
+# Number of notes per transaction when importing
+IMPORT_BATCH_SIZE = 5000
+# Number of notes fetched at once when exporting
+EXPORT_BATCH_SIZE = 1000
+# Max number of operations in a single batch request
+MAX_BATCH_OPERATIONS = 1000
+# Max number of index pages cached when themes are unknown
+INDEX_CACHE_SIZE = 32
+# Static files of themes
+THEME_PATTERN = re.compile(r"css/theme-([\w-]+)\.css")
+# Versioned static files never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Seconds between comments keeping idle event streams open through proxies
+EVENTS_HEARTBEAT = 15.0
+# Milliseconds browsers wait before reconnecting to event streams
+EVENTS_RETRY = 3000
 
-def APITagsView(*, db: monad.Database) -> web.View:
+
+async def _iter_lines(content):
+    """Iterate over lines of a request body without reading it at once."""
+    buffer = b""
+    async for chunk in content.iter_any():
+        *lines, rest = chunk.split(b"\n")
+        if lines:
+            lines[0] = buffer + lines[0]
+            buffer = b""
+            for _ in lines:
+                yield _
+        buffer += rest
+    if buffer:
+        yield buffer
+
+
+async def _read_note(request):
+    """Read the note sent in a request body, or answer 400 if invalid."""
+    try:
+        data = await request.json()
+    except ValueError:
+        error.invalid_note()
+
+    if not isinstance(data, dict) or not monad.is_valid_note(data.get("data")):
+        error.invalid_note()
+
+    return data["data"]
+
+
+def APITagsView(*, db: monad.AsyncDatabase) -> web.View:
     class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        @validator.conditional(db.etag)
         @validator.filtering
         async def get(self, *, filters):
-            return db.get_tags(filters=filters)
+            return await db.get_tags(
+                filters=filters, prefix=self.request.rel_url.query.get("prefix", None)
+            )
 
     return Wrapper
 
 
-def APINotesView(*, db: monad.Database) -> web.View:
+def APINotesView(*, db: monad.AsyncDatabase) -> web.View:
     class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        @validator.conditional(db.etag)
         @validator.filtering
         async def get(self, *, filters):
             query = self.request.rel_url.query
 
-            return db.get_notes(
+            # Only changes since last sync
+            if "since" in query:
+                if not query["since"].isdigit():
+                    raise monad.InvalidFilter("since")
+
+                return await db.get_changes(filters=filters, since=int(query["since"]))
+
+            return await db.get_notes(
                 filters=filters,
                 ids=[int(_) for _ in query["ids"].split(",")]
                 if "ids" in query
@@ -37,51 +98,306 @@ def APINotesView(*, db: monad.Database) -> web.View:
             )
 
         async def put(self):
-            data = await self.request.json()
-            note = db.add_note(data["data"])
+            note = await db.add_note(await _read_note(self.request))
             if not note:
                 return web.HTTPInternalServerError()
 
-            return web.Response(text=json.dumps(note, ensure_ascii=False))
+            return encoder.json_response(note)
 
     return Wrapper
 
 
-def APINoteByIdView(*, db: monad.Database) -> web.View:
+def APINoteByIdView(*, db: monad.AsyncDatabase) -> web.View:
     class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        @validator.conditional(db.etag)
         async def get(self):
             id = int(self.request.match_info["id"])
-            note = db.get_note_by_id(id)
+            note = await db.get_note_by_id(id)
             if not note:
                 return web.HTTPNotFound()
 
-            return web.Response(text=json.dumps(note, ensure_ascii=False))
+            return encoder.json_response(note)
 
         async def post(self):
             id = int(self.request.match_info["id"])
-            data = await self.request.json()
-            note = db.update_note(id, data["data"])
+            note = await db.update_note(id, await _read_note(self.request))
             if not note:
                 return web.HTTPNotFound()
 
-            return web.Response(text=json.dumps(note, ensure_ascii=False))
+            return encoder.json_response(note)
+
+    return Wrapper
+
+
+def APINotesImportView(*, db: monad.AsyncDatabase, batch_size: int) -> web.View:
+    class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        async def post(self):
+            total = 0
+            notes = []
+            line = 0
+            first_line = 1
+
+            async def flush():
+                nonlocal total, notes
+                try:
+                    total += await db.import_notes(notes)
+                except sqlite3.IntegrityError:
+                    error.invalid_import(
+                        first_line,
+                        f"an id of this batch already exists, {total} notes imported",
+                    )
+                notes = []
+
+            async for _ in _iter_lines(self.request.content):
+                line += 1
+                if not _.strip():
+                    continue
+
+                try:
+                    data = json.loads(_)
+                except ValueError:
+                    data = None
+                if not monad.is_valid_note(data):
+                    error.invalid_import(line, f"invalid note, {total} notes imported")
+
+                if not notes:
+                    first_line = line
+                notes.append(data)
+                if len(notes) >= batch_size:
+                    await flush()
+
+            if notes:
+                await flush()
+
+            return encoder.json_response({"imported": total})
+
+    return Wrapper
+
+
+def APINotesExportView(*, db: monad.AsyncDatabase, batch_size: int) -> web.View:
+    class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        async def get(self):
+            resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            resp.enable_chunked_encoding()
+            await resp.prepare(self.request)
+
+            async for notes in db.export_notes(batch_size=batch_size):
+                await resp.write(b"".join(encoder.dumps(_) + b"\n" for _ in notes))
+
+            await resp.write_eof()
+            return resp
+
+    return Wrapper
+
+
+def _batch_result(result) -> Dict[str, Any]:
+    """Describe the result of a batch operation with an HTTP status."""
+    if isinstance(result, sqlite3.IntegrityError):
+        return {
+            "status": 409,
+            "error": "conflict",
+            "error_description": "a note with this id already exists",
+        }
+    if isinstance(result, Exception):
+        return {
+            "status": 400,
+            "error": "invalid_operation",
+            "error_description": str(result),
+        }
+    if result is None:
+        return {
+            "status": 404,
+            "error": "not_found",
+            "error_description": "note not found",
+        }
+    return {"status": 200, "data": result}
+
+
+def APIBatchView(*, db: monad.AsyncDatabase, max_operations: int) -> web.View:
+    class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        async def post(self):
+            try:
+                data = await self.request.json()
+            except ValueError:
+                error.invalid_batch("body must be JSON")
+
+            operations = (
+                data.get("operations", None) if isinstance(data, dict) else None
+            )
+            if not isinstance(operations, list):
+                error.invalid_batch("operations must be a list")
+            if len(operations) > max_operations:
+                error.invalid_batch(f"at most {max_operations} operations are allowed")
+            atomic = data.get("atomic", False)
+            if not isinstance(atomic, bool):
+                error.invalid_batch("atomic must be a boolean")
+
+            try:
+                results = await db.batch(operations, atomic=atomic)
+            except monad.BatchError as e:
+                result = _batch_result(e.cause)
+                error.batch_aborted(e.index, result["error_description"])
+
+            return encoder.json_response(
+                {"results": [_batch_result(_) for _ in results]}
+            )
+
+    return Wrapper
+
+
+def APIEventsView(*, db: monad.AsyncDatabase, feed: ChangeFeed) -> web.View:
+    class Wrapper(web.View, aiohttp_cors.CorsViewMixin):
+        async def get(self):
+            resp = web.StreamResponse(
+                headers={
+                    "Content-Type": "text/event-stream",
+                    "Cache-Control": "no-cache",
+                    # Don't let nginx buffer events
+                    "X-Accel-Buffering": "no",
+                }
+            )
+            await resp.prepare(self.request)
+            await resp.write(f"retry: {EVENTS_RETRY}\n\n".encode("utf-8"))
+
+            async for event in feed.subscribe(
+                self.request.headers.get("Last-Event-ID", None),
+                generation=lambda: db.generation,
+                heartbeat=EVENTS_HEARTBEAT,
+            ):
+                if event is None:
+                    await resp.write(b": ping\n\n")
+                    continue
+
+                await resp.write(
+                    f"id: {event.id}\nevent: {event.type}\ndata: ".encode("utf-8")
+                    + encoder.dumps(event.data)
+                    + b"\n\n"
+                )
+
+            await resp.write_eof()
+            return resp
+
+    return Wrapper
+
+
+def IndexView(
+    *, api_base_url: str, cdn_url: str, default_theme: str, themes: Set[str] = None
+) -> web.View:
+    # Rendered page and its ETag by theme
+    pages = {}
+
+    class Wrapper(web.View):
+        def _render(self, theme):
+            body = aiohttp_jinja2.render_string(
+                "index.html",
+                self.request,
+                {"api_base_url": api_base_url, "cdn_url": cdn_url, "theme": theme},
+            ).encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:16])
+            return body, etag
+
+        async def get(self):
+            theme = self.request.rel_url.query.get("theme", default_theme)
+            if themes is not None and theme not in themes:
+                theme = default_theme
+
+            page = pages.get(theme, None)
+            if page is None:
+                page = self._render(theme)
+                # Without a list of themes, only cache a few ones
+                if themes is not None or len(pages) < INDEX_CACHE_SIZE:
+                    pages[theme] = page
+
+            body, etag = page
+            if validator.match_etag(self.request, etag):
+                raise web.HTTPNotModified(headers={"ETag": etag})
+
+            return web.Response(
+                body=body,
+                content_type="text/html",
+                charset="utf-8",
+                headers={"ETag": etag},
+            )
+
+    return Wrapper
+
+
+def _themes(static_dir: str, manifest: Dict[str, str]) -> Optional[Set[str]]:
+    """Get the names of themes from **css/theme-{name}.css** static files.
+
+    :param static_dir: directory containing static files
+    :param manifest: manifest of built static files
+    :return: names of themes, or `None` if static files are not local
+    """
+    if manifest is not None:
+        paths = manifest.keys()
+    elif static_dir is not None and os.path.isdir(os.path.join(static_dir, "css")):
+        paths = ["css/" + _ for _ in os.listdir(os.path.join(static_dir, "css"))]
+    else:
+        return None
+
+    return set(m.group(1) for m in map(THEME_PATTERN.fullmatch, paths) if m)
+
+
+def AssetView(*, assets_dir: str, manifest: Dict[str, str]) -> web.View:
+    versioned = set(manifest.values())
+
+    class Wrapper(web.View):
+        async def get(self):
+            path = self.request.match_info["path"]
+            if path in versioned:
+                cache_control = IMMUTABLE_CACHE_CONTROL
+            elif path in manifest:
+                # Unversioned URL, revalidated each time
+                path = manifest[path]
+                cache_control = "no-cache"
+            else:
+                raise web.HTTPNotFound()
+
+            # Picks the .br or .gz variant accepted by client if any
+            return web.FileResponse(
+                os.path.join(assets_dir, path),
+                headers={"Cache-Control": cache_control},
+            )
+
+        async def head(self):
+            return await self.get()
 
     return Wrapper
 
 
-def IndexView(*, api_base_url: str, cdn_url: str, default_theme: str) -> web.View:
+def MetricsView() -> web.View:
     class Wrapper(web.View):
-        @aiohttp_jinja2.template("index.html")
-        async def get(self, **_):
-            return {
-                "api_base_url": api_base_url,
-                "cdn_url": cdn_url,
-                "theme": self.request.rel_url.query.get("theme", default_theme),
-            }
+        async def get(self):
+            response = web.Response(body=metrics.render())
+            response.headers["Content-Type"] = metrics.CONTENT_TYPE
+            return response
 
     return Wrapper
 
 
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Count requests and their duration by route."""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        # Label by route template to keep a bounded number of series
+        route = resource.canonical if resource is not None else "unmatched"
+        metrics.REQUESTS.labels(route=route, method=request.method, status=status).inc()
+        metrics.REQUEST_DURATION.labels(route=route, method=request.method).observe(
+            time.perf_counter() - start
+        )
+
+
 def Application(
     *args,
     db: str,
@@ -91,8 +407,16 @@ def Application(
     swagger_yml: str = None,
     swagger_url: str = None,
     static_dir: str = None,
+    assets_dir: str = None,
     api_base_url: str = None,
     base_url: str = None,
+    metrics_url: str = None,
+    db_workers: int = None,
+    json_encoder: str = None,
+    db_generation: monad.Generation = None,
+    commit_interval: float = None,
+    commit_batch_size: int = None,
+    events_buffer_size: int = None,
     **kwargs
 ):
     """Create the server application.
@@ -105,16 +429,50 @@ def Application(
     :param swagger_yml:
     :param swagger_url:
     :param static_dir: directory containing static files
+    :param assets_dir: directory containing static files built for production
     :param api_base_url:
     :param base_url:
+    :param metrics_url: URL for exposing metrics to Prometheus, or `None`
+    :param db_workers: number of threads running database queries
+    :param json_encoder: `json`, `orjson` or `auto` for the fastest installed
+    :param db_generation: counter of writes shared by worker processes
+    :param commit_interval: seconds to wait for more writes before committing
+    :param commit_batch_size: max number of writes committed at once
+    :param events_buffer_size: max number of events kept for clients resuming
     :param kargs: additional kargs to **aiohttp**
     :return: application
     """
-    db = monad.Database(db)
+    encoder.setup(json_encoder)
+    feed = ChangeFeed(size=events_buffer_size)
+    db = monad.AsyncDatabase(
+        db,
+        workers=db_workers,
+        generation=db_generation,
+        commit_interval=commit_interval,
+        commit_batch_size=commit_batch_size,
+        feed=feed,
+    )
 
+    if metrics_url:
+        kwargs["middlewares"] = [metrics_middleware] + list(
+            kwargs.get("middlewares", [])
+        )
     app = web.Application(*args, **kwargs)
 
-    aiohttp_jinja2.setup(app, loader=jinja2.FileSystemLoader(jinja2_templates_dir))
+    async def close_db(app):
+        db.close()
+
+    async def close_feed(app):
+        feed.close()
+
+    app.on_shutdown.append(close_feed)
+    app.on_cleanup.append(close_db)
+
+    manifest = assets.load_manifest(assets_dir) if assets_dir else None
+    env = aiohttp_jinja2.setup(
+        app, loader=jinja2.FileSystemLoader(jinja2_templates_dir)
+    )
+    env.globals["asset_url"] = partial(assets.url_for, cdn_url, manifest)
 
     base_url = base_url or "/"
     if base_url[-1] != "/":
@@ -135,22 +493,53 @@ def Application(
         },
     )
 
-    if static_dir is not None:
+    if manifest is not None:
+        app.router.add_view(
+            cdn_url + "/{path:.+}", AssetView(assets_dir=assets_dir, manifest=manifest)
+        )
+    elif static_dir is not None:
         app.add_routes([web.static(cdn_url, static_dir)])
 
     # Web
     app.router.add_view(
         base_url,
         IndexView(
-            api_base_url=api_base_url, cdn_url=cdn_url, default_theme=default_theme
+            api_base_url=api_base_url,
+            cdn_url=cdn_url,
+            default_theme=default_theme,
+            themes=_themes(static_dir, manifest),
         ),
     )
 
+    if metrics_url:
+        app.router.add_view(metrics_url, MetricsView())
+
     # API
+    cors.add(
+        app.router.add_view(api_base_url + "events", APIEventsView(db=db, feed=feed))
+    )
+    cors.add(
+        app.router.add_view(
+            api_base_url + "batch",
+            APIBatchView(db=db, max_operations=MAX_BATCH_OPERATIONS),
+        )
+    )
     cors.add(app.router.add_view(api_base_url + "tags", APITagsView(db=db)))
     cors.add(app.router.add_view(api_base_url + "tags/", APITagsView(db=db)))
     cors.add(app.router.add_view(api_base_url + "notes", APINotesView(db=db)))
     cors.add(app.router.add_view(api_base_url + "notes/", APINotesView(db=db)))
+    cors.add(
+        app.router.add_view(
+            api_base_url + "notes/import",
+            APINotesImportView(db=db, batch_size=IMPORT_BATCH_SIZE),
+        )
+    )
+    cors.add(
+        app.router.add_view(
+            api_base_url + "notes/export",
+            APINotesExportView(db=db, batch_size=EXPORT_BATCH_SIZE),
+        )
+    )
     cors.add(
         app.router.add_view(api_base_url + "notes/{id:[0-9]+}", APINoteByIdView(db=db))
     )
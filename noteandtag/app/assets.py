@@ -0,0 +1,114 @@
+"""Module for building and referencing versioned static files.
+
+The build step copies each static file under a name containing a hash of
+its content, along with gzip and, when `brotli <https://github.com/google/brotli>`_
+is installed, brotli variants. A manifest maps original names to versioned
+ones, so that versioned files never change and can be cached forever.
+"""
+__all__ = ["MANIFEST", "build", "load_manifest", "url_for"]
+import gzip
+import hashlib
+import io
+import json
+import os
+from typing import Dict, Optional
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Name of the manifest written with versioned files
+MANIFEST = "manifest.json"
+# Number of hexadecimal digits of the hash in versioned names
+HASH_LENGTH = 12
+# Extensions of files worth compressing
+COMPRESSED_EXTENSIONS = (".css", ".js", ".svg", ".html", ".json", ".txt")
+
+
+def _gzip(content: bytes) -> bytes:
+    # Fixed mtime so that building twice gives identical files
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buffer.getvalue()
+
+
+COMPRESSORS = {".gz": _gzip}
+if brotli is not None:
+    COMPRESSORS[".br"] = lambda content: brotli.compress(content, quality=11)
+
+
+def _write(path: str, content: bytes) -> None:
+    # Replace atomically so that a running server never reads partial files
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def build(static_dir: str, assets_dir: str) -> Dict[str, str]:
+    """Build versioned and compressed static files.
+
+    Files from previous builds are kept so that pages loaded before
+    still find them.
+
+    :param static_dir: directory containing static files
+    :param assets_dir: output directory
+    :return: manifest mapping original names to versioned ones
+    """
+    manifest = {}
+    for root, _, files in os.walk(static_dir):
+        for name in sorted(files):
+            src = os.path.join(root, name)
+            path = os.path.relpath(src, static_dir).replace(os.sep, "/")
+            with open(src, "rb") as f:
+                content = f.read()
+
+            stem, ext = os.path.splitext(path)
+            digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+            versioned = f"{stem}.{digest}{ext}"
+            dst = os.path.join(assets_dir, versioned)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            _write(dst, content)
+
+            if ext in COMPRESSED_EXTENSIONS:
+                for suffix, compress in COMPRESSORS.items():
+                    compressed = compress(content)
+                    # Only keep variants that are smaller
+                    if len(compressed) < len(content):
+                        _write(dst + suffix, compressed)
+
+            manifest[path] = versioned
+
+    _write(
+        os.path.join(assets_dir, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+    )
+    return manifest
+
+
+def load_manifest(assets_dir: str) -> Optional[Dict[str, str]]:
+    """Load the manifest written by :func:`build`.
+
+    :param assets_dir: directory containing versioned files
+    :return: manifest or `None` if not built
+    """
+    try:
+        with open(os.path.join(assets_dir, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def url_for(cdn_url: str, manifest: Optional[Dict[str, str]], path: str) -> str:
+    """Get the URL of a static file, versioned if found in manifest.
+
+    :param cdn_url: URL for serving static files
+    :param manifest: manifest or `None`
+    :param path: original name of static file
+    :return: URL of static file
+    """
+    if manifest:
+        path = manifest.get(path, path)
+    return f"{cdn_url}/{path}"
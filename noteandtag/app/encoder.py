@@ -0,0 +1,72 @@
+"""Module for encoding REST API responses to JSON.
+
+`orjson <https://github.com/ijl/orjson>`_ is used when installed as it is
+much faster, otherwise this falls back to the standard `json` module.
+"""
+__all__ = ["BACKENDS", "CONTENT_TYPE", "setup", "backend", "dumps", "json_response"]
+import json
+from aiohttp import web
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Content type of all JSON responses, streamed or not
+CONTENT_TYPE = "text/plain"
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+BACKENDS = {"json": _json_dumps}
+if orjson is not None:
+    BACKENDS["orjson"] = orjson.dumps
+
+_backend = "orjson" if orjson is not None else "json"
+_dumps = BACKENDS[_backend]
+
+
+def setup(name: str = None) -> None:
+    """Select the JSON encoder.
+
+    Raise a `ValueError` if the encoder is not installed.
+
+    :param name: `json`, `orjson` or `auto` for the fastest one installed
+    """
+    global _backend, _dumps
+
+    if name is None or name == "auto":
+        name = "orjson" if "orjson" in BACKENDS else "json"
+    if name not in BACKENDS:
+        raise ValueError(f"JSON encoder {name} is not available")
+
+    _backend = name
+    _dumps = BACKENDS[name]
+
+
+def backend() -> str:
+    """Get the name of selected JSON encoder."""
+    return _backend
+
+
+def dumps(obj) -> bytes:
+    """Encode an object to compact UTF-8 JSON.
+
+    :param obj: object to encode
+    :return: encoded object
+    """
+    return _dumps(obj)
+
+
+def json_response(obj, **kwargs) -> web.Response:
+    """Create a response from an object encoded to JSON.
+
+    :param obj: object to encode
+    :param kwargs: additional kwargs to `aiohttp.web.Response`
+    :return: response
+    """
+    return web.Response(
+        body=_dumps(obj), content_type=CONTENT_TYPE, charset="utf-8", **kwargs
+    )
@@ -1,6 +1,13 @@
 """Module for errors returned by the REST API.
 """
-__all__ = ["bad_request", "invalid_parameter"]
+__all__ = [
+    "bad_request",
+    "invalid_parameter",
+    "invalid_import",
+    "invalid_batch",
+    "batch_aborted",
+    "invalid_note",
+]
 import json
 from aiohttp import web
 
@@ -45,3 +52,77 @@ def invalid_parameter(name: str) -> web.HTTPBadRequest:
     bad_request(
         label="invalid_parameter", code=0, description=f"check your {name} parameter"
     )
+
+
+def invalid_import(line: int, description: str) -> web.HTTPBadRequest:
+    """Raise a **400 (BadRequest)** invalid_import error:
+
+    .. code-block:: python
+
+        {
+            "error": "invalid_import",
+            "code": 1,
+            "description": "line {line}: {description}"
+        }
+
+    :param line: line number in imported file
+    :param description: description for debug purpose
+    """
+    bad_request(
+        label="invalid_import", code=1, description=f"line {line}: {description}"
+    )
+
+
+def invalid_batch(description: str) -> web.HTTPBadRequest:
+    """Raise a **400 (BadRequest)** invalid_batch error:
+
+    .. code-block:: python
+
+        {
+            "error": "invalid_batch",
+            "code": 2,
+            "description": "{description}"
+        }
+
+    :param description: description for debug purpose
+    """
+    bad_request(label="invalid_batch", code=2, description=description)
+
+
+def batch_aborted(index: int, description: str) -> web.HTTPBadRequest:
+    """Raise a **400 (BadRequest)** batch_aborted error:
+
+    .. code-block:: python
+
+        {
+            "error": "batch_aborted",
+            "code": 3,
+            "description": "operation {index}: {description}"
+        }
+
+    :param index: index of the failing operation
+    :param description: description for debug purpose
+    """
+    bad_request(
+        label="batch_aborted",
+        code=3,
+        description=f"operation {index}: {description}, nothing was applied",
+    )
+
+
+def invalid_note() -> web.HTTPBadRequest:
+    """Raise a **400 (BadRequest)** invalid_note error:
+
+    .. code-block:: python
+
+        {
+            "error": "invalid_note",
+            "code": 4,
+            "description": "note must have label, author, body and tags"
+        }
+    """
+    bad_request(
+        label="invalid_note",
+        code=4,
+        description="note must have label, author, body and tags",
+    )
@@ -1,12 +1,15 @@
 """Module for validating user inputs to the REST API.
 """
-__all__ = ["filtering"]
+__all__ = ["filtering", "conditional", "match_etag"]
+import base64
+import inspect
 import json
 import re
 from aiohttp import web
 from functools import wraps
-from noteandtag.app import error
-from typing import List
+from noteandtag import monad
+from noteandtag.app import encoder, error
+from typing import Awaitable, Callable, List, Union
 
 
 def _parse_int_query_param(request, name: str) -> int:
@@ -27,6 +30,78 @@ def _parse_int_query_param(request, name: str) -> int:
         error.invalid_parameter(name)
 
 
+def _parse_bool_query_param(request, name: str) -> bool:
+    """Parse a query parameter as bool.
+
+    Accepted values are **1**, **true**, **0** and **false**.
+
+    Raise an **invalid_parameter** error if the value is not one of them.
+
+    :param request: HTTP request
+    :param name: parameter name
+    :return: parameter value
+    """
+    if name not in request.rel_url.query:
+        return None
+
+    value = request.rel_url.query[name].lower()
+    if value not in ("1", "true", "0", "false"):
+        error.invalid_parameter(name)
+
+    return value in ("1", "true")
+
+
+def _parse_limit_query_param(request, name: str, maximum: int) -> int:
+    """Parse the limit query parameter.
+
+    Raise an **invalid_parameter** error if not between 1 and max limit.
+
+    :param request: HTTP request
+    :param name: parameter name
+    :param maximum: max limit
+    :return: parameter value
+    """
+    value = _parse_int_query_param(request, name)
+    if value is not None and not 1 <= value <= maximum:
+        error.invalid_parameter(name)
+
+    return value
+
+
+def _encode_cursor(key: List) -> str:
+    """Encode the key of last item as an opaque cursor.
+
+    :param key: key of last item
+    :return: cursor
+    """
+    data = json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _parse_cursor_query_param(request, name: str) -> List:
+    """Parse a cursor returned in a previous **Link** header.
+
+    Raise an **invalid_parameter** error if an exception occurs.
+
+    :param request: HTTP request
+    :param name: parameter name
+    :return: key of last item of previous page
+    """
+    if name not in request.rel_url.query:
+        return None
+
+    try:
+        value = request.rel_url.query[name]
+        key = json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except:
+        error.invalid_parameter(name)
+
+    if not isinstance(key, list):
+        error.invalid_parameter(name)
+
+    return key
+
+
 def _parse_sort_query_param(request, name: str) -> List:
     """Parse the sortBy query parameter.
 
@@ -53,11 +128,9 @@ def _parse_sort_query_param(request, name: str) -> List:
 
     items = []
     params = request.rel_url.query[name].split(",")
-    print(params)
     pattern = r"^(?P<field>\w+)(?:\:(?P<order>asc|desc))?$"
     for _ in params:
         m = re.match(pattern, _)
-        print(_, m)
         if not m:
             error.invalid_parameter(name)
 
@@ -67,11 +140,17 @@ def _parse_sort_query_param(request, name: str) -> List:
 
 
 def filtering(fun):
-    """Filter results by offset and limit.
+    """Filter results by offset and limit, or by cursor.
 
     .. code-block:: python
 
         "X-Total-Count": {total}
+        "Link": <{url}?after={cursor}>; rel="next"
+
+    The **Link** header is only present when there may be a next page.
+
+    With **stream=true**, pages can be much larger and are written while
+    being read from DB, but have no **Link** header.
 
     Raise an **invalid_parameter** error if user inputs are invalid.
 
@@ -79,25 +158,130 @@ def filtering(fun):
 
     @wraps(fun)
     async def wrapper(self, *args, **kwargs):
+        stream = _parse_bool_query_param(self.request, "stream")
+
         # Filter items according to parameters
-        items, total = await fun(
-            self,
-            *args,
-            filters={
-                "offset": _parse_int_query_param(self.request, "offset"),
-                "limit": _parse_int_query_param(self.request, "limit"),
-                "sort": _parse_sort_query_param(self.request, "sortBy"),
-            },
-            **kwargs
-        )
+        try:
+            items, total, after = await fun(
+                self,
+                *args,
+                filters={
+                    "offset": _parse_int_query_param(self.request, "offset"),
+                    "limit": _parse_limit_query_param(
+                        self.request,
+                        "limit",
+                        monad.MAX_STREAM_LIMIT if stream else monad.MAX_LIMIT,
+                    ),
+                    "sort": _parse_sort_query_param(self.request, "sortBy"),
+                    "after": _parse_cursor_query_param(self.request, "after"),
+                    "stream": stream,
+                },
+                **kwargs,
+            )
+        except monad.InvalidFilter as e:
+            error.invalid_parameter(e.name)
 
         # Return items and total count
-        return web.Response(
-            text=json.dumps(
-                items,
-                ensure_ascii=False,
-            ),
-            headers={"X-Total-Count": str(total)},
-        )
+        headers = {"X-Total-Count": str(total)}
+        if not isinstance(items, list):
+            return await _stream(self.request, items, headers)
+
+        if after is not None:
+            query = dict(self.request.rel_url.query)
+            query.pop("offset", None)
+            query["after"] = _encode_cursor(after)
+            headers["Link"] = '<{}>; rel="next"'.format(
+                self.request.rel_url.with_query(query)
+            )
+
+        return encoder.json_response(items, headers=headers)
 
     return wrapper
+
+
+async def _stream(request, chunks, headers) -> web.StreamResponse:
+    """Write chunks of items as a JSON list while they are read from DB.
+
+    :param request: HTTP request
+    :param chunks: asynchronous generator of chunks
+    :param headers: response headers
+    :return: response
+    """
+    response = web.StreamResponse(headers=headers)
+    response.content_type = encoder.CONTENT_TYPE
+    response.charset = "utf-8"
+    if "etag" in request:
+        response.headers["ETag"] = request["etag"]
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    # Release the DB thread right away if client disconnects
+    try:
+        separator = b"["
+        async for chunk in chunks:
+            # Encode the whole chunk at once without its brackets
+            await response.write(separator + encoder.dumps(chunk)[1:-1])
+            separator = b","
+        await response.write(b"[]" if separator == b"[" else b"]")
+    finally:
+        await chunks.aclose()
+
+    await response.write_eof()
+    return response
+
+
+def match_etag(request, etag: str) -> bool:
+    """Check if the **If-None-Match** header matches an ETag.
+
+    :param request: HTTP request
+    :param etag: current ETag
+    :return: if client already has this version
+    """
+    header = request.headers.get("If-None-Match", None)
+    if header is None:
+        return False
+
+    for _ in header.split(","):
+        _ = _.strip()
+        if _ == "*" or (_[2:] if _.startswith("W/") else _) == etag:
+            return True
+
+    return False
+
+
+def conditional(etag: Callable[[], Union[str, Awaitable[str]]]):
+    """Answer conditional GET requests.
+
+    Respond with **304 (Not Modified)** without calling the view if the
+    **If-None-Match** header matches the current ETag. Otherwise the ETag
+    is sent along with the response:
+
+    .. code-block:: python
+
+        "ETag": {etag}
+
+    :param etag: function returning the current ETag, or an awaitable
+    """
+
+    def decorator(fun):
+        @wraps(fun)
+        async def wrapper(self, *args, **kwargs):
+            # Read it before querying so it can't be newer than the data
+            value = etag()
+            if inspect.isawaitable(value):
+                value = await value
+            if match_etag(self.request, value):
+                raise web.HTTPNotModified(headers={"ETag": value})
+
+            # For responses streamed before returning
+            self.request["etag"] = value
+
+            response = await fun(self, *args, **kwargs)
+            if response.status == 200 and not response.prepared:
+                response.headers["ETag"] = value
+
+            return response
+
+        return wrapper
+
+    return decorator
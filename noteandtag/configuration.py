@@ -8,14 +8,27 @@ DEFAULT_CONFIG = {
         "cdn-url": "",
         "default-theme": "default",
         "db": "notes.yml",
+        "workers": 1,
+        "db-workers": 4,
+        "json-encoder": "auto",
+        "commit-interval": 0,
+        "commit-batch-size": 100,
+        "events-buffer-size": 1000,
     },
     "logging": {
         "access-logfile": "",
         "access-maxbytes": DEFAULT_LOGGING_MAXBYTES,
         "access-backupcount": DEFAULT_LOGGING_BACKUPCOUNT,
+        "access-sample-rate": 1.0,
         "error-logfile": "",
         "error-maxbytes": DEFAULT_LOGGING_MAXBYTES,
         "error-backupcount": DEFAULT_LOGGING_BACKUPCOUNT,
+        "slow-query-logfile": "",
+        "slow-query-threshold": "",
+        "slow-query-sample-rate": 1.0,
+        "slow-query-rate-limit": 10,
+        "queue-size": 10000,
+        "drop-policy": "drop",
     },
 }
 
@@ -0,0 +1,201 @@
+"""Module for pushing changes of notes to clients.
+
+Writes to DB publish events to a :class:`ChangeFeed`, that keeps the last
+ones in memory so that clients reconnecting with the id of the last event
+they received don't miss any:
+
+.. code-block:: python
+
+    feed.publish("note-updated", note, generation=generation)
+    async for event in feed.subscribe(last_event_id):
+        ...
+
+Events are only known by the process doing the write, and are published
+with the generation of the commit that wrote them. Other processes sharing
+the DB notice generations they didn't commit, and publish a `reset` event
+instead, telling clients to fetch everything again.
+"""
+__all__ = ["Event", "ChangeFeed"]
+import asyncio
+import collections
+import time
+import uuid
+from typing import Callable
+
+# Max number of events kept for clients resuming
+DEFAULT_SIZE = 1000
+# Seconds between checks for writes done by other processes
+SYNC_INTERVAL = 1.0
+
+Event = collections.namedtuple("Event", ["id", "seq", "type", "data"])
+
+
+class ChangeFeed:
+    """Ring buffer of events published by writes.
+
+    :param size: max number of events kept for clients resuming
+    """
+
+    def __init__(self, *, size: int = None):
+        # Unique to this feed so that ids of another process are never resumed
+        self.instance = uuid.uuid4().hex[:16]
+        self._events = collections.deque(maxlen=size or DEFAULT_SIZE)
+        self._seq = 0
+        # Last generation committed by this process or known to clients
+        self._generation = None
+        # When a later generation was first seen without being published
+        self._unpublished_since = None
+        self._waiters = set()
+        self._closed = False
+
+    @property
+    def last_event_id(self) -> str:
+        """Id of last published event."""
+        return f"{self.instance}-{self._seq}"
+
+    def publish(self, type: str, data, *, generation: int = None) -> Event:
+        """Publish an event and wake up subscribers.
+
+        :param type: type of event
+        :param data: JSON serializable data
+        :param generation: generation of the commit including this change
+        :return: event
+        """
+        if generation is not None:
+            self.advance(generation)
+        return self._append(type, data)
+
+    def advance(self, generation: int) -> None:
+        """Record a commit of this process, even if it published no event.
+
+        Generations are consecutive, so skipping some means other processes
+        committed since the last commit of this one: a `reset` event is
+        published first.
+
+        :param generation: generation of the commit
+        """
+        if self._generation is not None and generation > self._generation + 1:
+            self._append("reset", {})
+        if self._generation is None or generation > self._generation:
+            self._generation = generation
+            self._unpublished_since = None
+
+    def sync(self, generation: int) -> None:
+        """Publish a `reset` event if DB was written without publishing.
+
+        A commit of this process is published shortly after the generation
+        is incremented, so a later generation only means another process
+        wrote once it stays unpublished for `SYNC_INTERVAL`.
+
+        :param generation: current generation of DB
+        """
+        if self._generation is None:
+            self._generation = generation
+        if generation <= self._generation:
+            self._unpublished_since = None
+            return
+
+        now = time.monotonic()
+        if self._unpublished_since is None:
+            self._unpublished_since = now
+        elif now - self._unpublished_since >= SYNC_INTERVAL:
+            self._generation = generation
+            self._unpublished_since = None
+            self._append("reset", {})
+
+    def _append(self, type, data):
+        self._seq += 1
+        event = Event(f"{self.instance}-{self._seq}", self._seq, type, data)
+        self._events.append(event)
+
+        for _ in self._waiters:
+            if not _.done():
+                _.set_result(None)
+        self._waiters.clear()
+        return event
+
+    def close(self) -> None:
+        """Stop all subscribers."""
+        self._closed = True
+        self.publish("close", {})
+
+    def _after(self, seq):
+        """Get events published after `seq`, or `None` if some were dropped."""
+        if seq == self._seq:
+            return []
+        if not self._events or self._events[0].seq > seq + 1:
+            return None
+
+        return list(self._events)[seq + 1 - self._events[0].seq :]
+
+    def _parse(self, last_event_id):
+        """Get the sequence number of an event id, or `None` if unknown."""
+        instance, _, seq = (last_event_id or "").partition("-")
+        if instance != self.instance or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        return int(seq)
+
+    async def _wait(self, timeout):
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiters.discard(waiter)
+
+    async def subscribe(
+        self,
+        last_event_id: str = None,
+        *,
+        generation: Callable[[], int] = None,
+        heartbeat: float = None,
+    ):
+        """Iterate over events as they are published.
+
+        When `last_event_id` can't be resumed, because it was published by
+        another process or dropped from the buffer, a `reset` event is sent
+        first. The same happens when a subscriber is too slow to keep up.
+
+        :param last_event_id: id of last event received by client
+        :param generation: function returning the current generation of DB
+        :param heartbeat: seconds without events before yielding `None`
+        :return: async generator of events
+        """
+        # Writes done before subscribing don't concern new clients
+        if generation is not None:
+            self.sync(generation())
+
+        seq = self._seq
+        if last_event_id:
+            seq = self._parse(last_event_id)
+            if seq is None:
+                seq = self._seq
+                yield Event(self.last_event_id, seq, "reset", {})
+
+        idle = 0.0
+        while not self._closed:
+            events = self._after(seq)
+            if events is None:
+                seq = self._seq
+                yield Event(self.last_event_id, seq, "reset", {})
+                continue
+
+            for _ in events:
+                if _.type == "close":
+                    return
+                yield _
+                seq = _.seq
+            if events:
+                idle = 0.0
+                continue
+
+            await self._wait(SYNC_INTERVAL)
+            if generation is not None:
+                self.sync(generation())
+            if seq == self._seq:
+                idle += SYNC_INTERVAL
+                if heartbeat is not None and idle >= heartbeat:
+                    idle = 0.0
+                    yield None
@@ -0,0 +1,138 @@
+"""Module for writing logs from a background thread.
+
+Handlers attached with :func:`attach` don't run in the thread emitting
+records, such as the event loop. Records are put on a bounded queue and
+handled by a `QueueListener` thread, so that writing and rotating log
+files never blocks requests.
+
+When the queue is full, records are either dropped and counted in the
+`noteandtag_log_dropped_total` metric, or the emitting thread waits.
+"""
+__all__ = ["DROP_POLICIES", "SamplingFilter", "attach", "stop", "after_fork"]
+import atexit
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import List
+from noteandtag import metrics
+
+# Max number of records waiting to be written, per logger
+DEFAULT_QUEUE_SIZE = 10000
+DROP_POLICIES = ("drop", "block")
+
+# Attached (QueueHandler, handlers) pairs, restarted in forked processes
+_queues = []
+_listeners = []
+# Process the listener threads run in
+_pid = os.getpid()
+
+
+class _BoundedQueueHandler(QueueHandler):
+    """Put records on a bounded queue, dropping them or waiting when full.
+
+    :param queue: bounded queue
+    :param block: if full queue makes the emitting thread wait
+    """
+
+    def __init__(self, queue, *, block: bool):
+        super().__init__(queue)
+        self.block = block
+
+    def enqueue(self, record):
+        if self.block:
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_DROPPED.labels(logger=record.name).inc()
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of access log records.
+
+    Records of responses with an error status are always kept.
+
+    :param rate: fraction of records to keep
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, "response_status", 0) >= 400:
+            return True
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room in a full queue rather than failing to stop
+        self.queue.put(self._sentinel)
+
+
+def _start(handler: _BoundedQueueHandler, handlers: List[logging.Handler]):
+    listener = _Listener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+
+def attach(
+    logger: logging.Logger,
+    handlers: List[logging.Handler],
+    *,
+    queue_size: int = None,
+    drop_policy: str = "drop",
+) -> None:
+    """Write records of a logger to handlers from a background thread.
+
+    :param logger: logger emitting records
+    :param handlers: handlers writing records
+    :param queue_size: max number of records waiting to be written
+    :param drop_policy: `drop` new records or `block` when queue is full
+    """
+    if drop_policy not in DROP_POLICIES:
+        raise ValueError(f"unknown drop policy {drop_policy}")
+
+    handler = _BoundedQueueHandler(
+        queue.Queue(maxsize=queue_size or DEFAULT_QUEUE_SIZE),
+        block=drop_policy == "block",
+    )
+    logger.addHandler(handler)
+    _queues.append((handler, handlers))
+    _start(handler, handlers)
+
+
+def stop() -> None:
+    """Write pending records and stop background threads."""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def after_fork() -> None:
+    """Restart background threads in a forked process.
+
+    The listener threads are not running in a forked process, and their
+    queues may have been locked by them during fork. This runs by itself
+    after `os.fork` on Python 3.7+, and does nothing if called again from
+    the same process, so call it first thing in forked processes.
+    """
+    global _pid
+    if _pid == os.getpid():
+        return
+
+    _pid = os.getpid()
+    _listeners.clear()
+    for handler, handlers in _queues:
+        handler.queue = queue.Queue(maxsize=handler.queue.maxsize)
+        _start(handler, handlers)
+
+
+atexit.register(stop)
+# Python 3.6 has no fork hooks, see after_fork
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=after_fork)
@@ -0,0 +1,370 @@
+"""Module for collecting metrics in the Prometheus text format.
+
+Metrics are kept in memory by each process and are safe to update from
+the threads running database queries:
+
+.. code-block:: python
+
+    REQUESTS.labels(route="/", method="GET", status=200).inc()
+    with db_method("get_notes"):
+        ...
+
+Only counters, gauges and histograms with fixed buckets are supported.
+
+With several worker processes, each one calls :func:`setup_worker` after
+fork. Samples then get a `worker` label, and each worker regularly writes
+them to a shared directory, so that any worker can render the metrics of
+all of them.
+"""
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "REGISTRY",
+    "REQUESTS",
+    "REQUEST_DURATION",
+    "DB_CALL_DURATION",
+    "DB_QUERY_DURATION",
+    "DB_WRITE_DURATION",
+    "DB_PENDING",
+    "LOG_DROPPED",
+    "CONTENT_TYPE",
+    "db_method",
+    "observe_query",
+    "render",
+    "setup_worker",
+]
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+# Upper bounds in seconds of latency buckets
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# Seconds between writes of the samples of a worker to the shared directory
+SNAPSHOT_INTERVAL = 1.0
+
+# Index of this worker and directory shared by workers, see setup_worker
+_worker = None
+_directory = None
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            )
+            for k, v in pairs
+        )
+    )
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class _Metric:
+    """Base for metrics with optional labels.
+
+    :param name: metric name
+    :param documentation: help text
+    :param labelnames: names of labels
+    """
+
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: List[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+        REGISTRY.append(self)
+
+    def labels(self, **labels):
+        """Get the child metric for a set of label values."""
+        key = tuple(str(labels[_]) for _ in self.labelnames)
+        child = self._children.get(key, None)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+
+    def samples(self) -> List[str]:
+        labelnames = self.labelnames
+        if _worker is not None:
+            labelnames += ("worker",)
+
+        lines = []
+        with self._lock:
+            children = sorted(self._children.items())
+        for key, child in children:
+            if _worker is not None:
+                key += (str(_worker),)
+            lines.extend(child.collect(self.name, labelnames, key))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def collect(self, name, labelnames, key):
+        return [f"{name}{_format_labels(labelnames, key)} {_format_value(self._value)}"]
+
+
+class Counter(_Metric):
+    """Value that only goes up."""
+
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    """Value that can go up and down."""
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of a block of code."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def collect(self, name, labelnames, key):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(labelnames, key, ("le", _format_value(bound)))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = _format_labels(labelnames, key)
+        lines.append(f"{name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{name}_count{labels} {cumulative}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Distribution of values, such as latencies, in fixed buckets.
+
+    :param buckets: sorted upper bounds of buckets
+    """
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Tuple[float] = DEFAULT_BUCKETS, **kwargs):
+        self._buckets = tuple(buckets)
+        super().__init__(*args, **kwargs)
+
+    def _new_child(self):
+        return _HistogramValue(self._buckets)
+
+
+REGISTRY = []
+
+REQUESTS = Counter(
+    "noteandtag_http_requests_total",
+    "Number of HTTP requests.",
+    ["route", "method", "status"],
+)
+REQUEST_DURATION = Histogram(
+    "noteandtag_http_request_duration_seconds",
+    "Duration of HTTP requests.",
+    ["route", "method"],
+)
+DB_CALL_DURATION = Histogram(
+    "noteandtag_db_call_duration_seconds",
+    "Duration of Database methods, run by DB threads.",
+    ["method"],
+)
+DB_QUERY_DURATION = Histogram(
+    "noteandtag_db_query_duration_seconds",
+    "Duration of SQL statements by Database method.",
+    ["method"],
+)
+DB_WRITE_DURATION = Histogram(
+    "noteandtag_db_write_duration_seconds",
+    "Duration of writes from queueing to commit.",
+    ["method"],
+)
+DB_PENDING = Gauge(
+    "noteandtag_db_pending",
+    "Number of DB calls waiting for a thread, by queue.",
+    ["queue"],
+)
+LOG_DROPPED = Counter(
+    "noteandtag_log_dropped_total",
+    "Number of log records dropped as the queue was full.",
+    ["logger"],
+)
+
+# Database method being run by current thread
+_local = threading.local()
+
+
+@contextmanager
+def db_method(name: str):
+    """Time a Database method and label the queries it runs.
+
+    :param name: name of the method
+    """
+    previous = getattr(_local, "method", None)
+    _local.method = name
+    try:
+        with DB_CALL_DURATION.labels(method=name).time():
+            yield
+    finally:
+        _local.method = previous
+
+
+def observe_query(duration: float):
+    """Record the duration of a SQL statement run by current thread.
+
+    :param duration: duration in seconds
+    """
+    DB_QUERY_DURATION.labels(method=getattr(_local, "method", None) or "other").observe(
+        duration
+    )
+
+
+def _snapshot_path(worker) -> str:
+    return os.path.join(_directory, f"worker-{worker}.json")
+
+
+def _write_snapshot():
+    # Replace the file at once so that readers never see a partial one
+    path = _snapshot_path(_worker)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({_.name: _.samples() for _ in REGISTRY}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _read_snapshots():
+    """Get the samples of other workers by metric name."""
+    snapshots = []
+    for name in sorted(os.listdir(_directory)):
+        if not name.endswith(".json") or name == f"worker-{_worker}.json":
+            continue
+
+        try:
+            with open(os.path.join(_directory, name), "r", encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _snapshot_loop():
+    while _worker is not None:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            _write_snapshot()
+        except OSError:
+            pass
+
+
+def setup_worker(worker: int, directory: str) -> None:
+    """Label samples of this process and share them with other workers.
+
+    A restarted worker takes the index of the one it replaces, so that its
+    counters are seen as reset instead of as new series.
+
+    :param worker: index of this worker
+    :param directory: directory shared by all workers
+    """
+    global _worker, _directory
+
+    _worker = worker
+    _directory = directory
+    _write_snapshot()
+    threading.Thread(
+        target=_snapshot_loop, name="noteandtag-metrics", daemon=True
+    ).start()
+
+
+def render() -> bytes:
+    """Render all metrics in the Prometheus text format.
+
+    With several workers, samples of this one are up to date and those of
+    others are at most `SNAPSHOT_INTERVAL` old.
+    """
+    snapshots = _read_snapshots() if _worker is not None else []
+
+    lines = []
+    for _ in REGISTRY:
+        lines.extend(_.header())
+        lines.extend(_.samples())
+        for snapshot in snapshots:
+            lines.extend(snapshot.get(_.name, []))
+    return ("\n".join(lines) + "\n").encode("utf-8")
@@ -0,0 +1,449 @@
+"""Module listing the versions of the database schema.
+
+The version of a database is stored in `PRAGMA user_version` and
+:meth:`noteandtag.monad.Database.migrate` applies each missing step in
+order. A step is made of:
+
+* **schema**: statements creating tables, indexes and triggers.
+* **backfill**: optional statements migrating existing rows by batches.
+  It is called with a cursor and a max number of rows, and returns whether
+  rows may remain.
+* **finish**: optional statements run once rows are migrated, such as
+  creating indexes on a backfilled column.
+
+Backfills walk rows by increasing id and store the last one migrated in
+the `migration_progress` table, so that they resume where they stopped.
+Triggers maintaining derived data, like tag counts or the full-text index,
+only apply to rows already migrated until the finish statements replace
+them, so that writes running meanwhile are neither lost nor counted twice.
+
+Databases created before versions existed are at version 0 and may already
+have part of the schema, so the steps of :data:`MIGRATIONS` up to version 4
+only create what is missing. Later steps can rely on the version.
+"""
+__all__ = ["Migration", "MIGRATIONS"]
+import collections
+import sqlite3
+
+Migration = collections.namedtuple(
+    "Migration", ["description", "schema", "backfill", "finish"]
+)
+# Keyword defaults of namedtuple need Python 3.7
+Migration.__new__.__defaults__ = (None, None)
+
+
+def _table_exists(cur, name):
+    return bool(
+        cur.query_value(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,)
+        )
+    )
+
+
+def _start_backfill(cur, name):
+    """Record that rows must be migrated, starting from the first one."""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "migration_progress" (
+            "name" TEXT NOT NULL,
+            "after" INTEGER NOT NULL,
+            PRIMARY KEY("name")
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute(
+        "INSERT OR IGNORE INTO migration_progress (name, after) VALUES (?, 0)",
+        (name,),
+    )
+
+
+def _progress(cur, name):
+    """Get the last id migrated by a backfill, or `None` if not running."""
+    if not _table_exists(cur, "migration_progress"):
+        return None
+
+    return cur.query_value("SELECT after FROM migration_progress WHERE name=?", (name,))
+
+
+def _backfill_ids(cur, name, stmt, limit):
+    """Migrate the next batch of ids selected by a statement.
+
+    :param name: name of the backfill
+    :param stmt: statement selecting ids after a given one, in order
+    :param limit: max number of rows
+    :return: a tuple (after, last) of ids to migrate, or `None` if done
+    """
+    after = _progress(cur, name)
+    if after is None:
+        return None
+
+    ids = cur.query(stmt, (after, limit))
+    if not ids:
+        return None
+
+    last = ids[-1]["id"]
+    cur.execute("UPDATE migration_progress SET after=? WHERE name=?", (last, name))
+    return after, last
+
+
+def _finish_backfill(cur, name):
+    """Check a backfill was running and forget its progress."""
+    if _progress(cur, name) is None:
+        return False
+
+    cur.execute("DELETE FROM migration_progress WHERE name=?", (name,))
+    return True
+
+
+def _create_notes(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "note" (
+            "id" INTEGER NOT NULL,
+            "label"	TEXT NOT NULL,
+            "author" TEXT NOT NULL,
+            "body" TEXT NOT NULL,
+            PRIMARY KEY("id" AUTOINCREMENT)
+        )
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "note_tag" (
+            "noteid" INTEGER NOT NULL,
+            "label" TEXT NOT NULL,
+            PRIMARY KEY("noteid", "label"),
+            FOREIGN KEY("noteid") REFERENCES note("id")
+        )
+        """
+    )
+
+    # Find notes by tag without scanning note_tag
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "note_tag_label"
+        ON note_tag("label", "noteid")
+        """
+    )
+
+
+def _create_tag_triggers(cur, *, migrated=""):
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS "tag_insert"
+        AFTER INSERT ON note_tag {migrated.format(row="new")} BEGIN
+            INSERT INTO tag (label, total)
+            VALUES (new.label, 1)
+            ON CONFLICT (label) DO UPDATE SET total = total + 1;
+        END
+        """
+    )
+
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS "tag_delete"
+        AFTER DELETE ON note_tag {migrated.format(row="old")} BEGIN
+            UPDATE tag SET total = total - 1 WHERE label = old.label;
+            DELETE FROM tag WHERE label = old.label AND total <= 0;
+        END
+        """
+    )
+
+
+def _count_tags(cur):
+    # Number of notes per tag, kept exact by triggers on note_tag
+    if not _table_exists(cur, "tag"):
+        cur.execute(
+            """
+            CREATE TABLE "tag" (
+                "label" TEXT NOT NULL,
+                "total" INTEGER NOT NULL,
+                PRIMARY KEY("label")
+            ) WITHOUT ROWID
+            """
+        )
+        _start_backfill(cur, "tag")
+
+    cur.execute('CREATE INDEX IF NOT EXISTS "tag_total" ON tag("total", "label")')
+
+    # Only count tags of notes already counted by the backfill
+    _create_tag_triggers(
+        cur,
+        migrated=""
+        if _progress(cur, "tag") is None
+        else """
+        WHEN {row}.noteid <= (
+            SELECT after FROM migration_progress WHERE name = 'tag'
+        )
+        """,
+    )
+
+
+def _count_note_tags(cur, limit):
+    ids = _backfill_ids(
+        cur,
+        "tag",
+        """
+        SELECT noteid AS id FROM note_tag
+        WHERE noteid > ? ORDER BY noteid LIMIT ?
+        """,
+        limit,
+    )
+    if ids is None:
+        return False
+
+    cur.execute(
+        """
+        INSERT INTO tag (label, total)
+        SELECT label, COUNT(noteid)
+        FROM note_tag
+        WHERE noteid > ? AND noteid <= ?
+        GROUP BY label
+        ON CONFLICT (label) DO UPDATE SET total = total + excluded.total
+        """,
+        ids,
+    )
+    return True
+
+
+def _finish_tags(cur):
+    if _finish_backfill(cur, "tag"):
+        cur.execute('DROP TRIGGER IF EXISTS "tag_insert"')
+        cur.execute('DROP TRIGGER IF EXISTS "tag_delete"')
+        _create_tag_triggers(cur)
+
+
+def _create_fts_triggers(cur, *, migrated=""):
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS "note_fts_insert"
+        AFTER INSERT ON note {migrated.format(row="new")} BEGIN
+            INSERT INTO note_fts(rowid, label, body)
+            VALUES (new.id, new.label, new.body);
+        END
+        """
+    )
+
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS "note_fts_delete"
+        AFTER DELETE ON note {migrated.format(row="old")} BEGIN
+            INSERT INTO note_fts(note_fts, rowid, label, body)
+            VALUES ('delete', old.id, old.label, old.body);
+        END
+        """
+    )
+
+    cur.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS "note_fts_update"
+        AFTER UPDATE ON note {migrated.format(row="old")} BEGIN
+            INSERT INTO note_fts(note_fts, rowid, label, body)
+            VALUES ('delete', old.id, old.label, old.body);
+            INSERT INTO note_fts(rowid, label, body)
+            VALUES (new.id, new.label, new.body);
+        END
+        """
+    )
+
+
+def _index_notes(cur):
+    # Sort notes without a temporary B-tree, the id is implicitly the last
+    # column of each index
+    cur.execute('CREATE INDEX IF NOT EXISTS "note_label" ON note("label")')
+    cur.execute('CREATE INDEX IF NOT EXISTS "note_author" ON note("author")')
+
+    # Full-text index on label and body, the trigram tokenizer allows
+    # matching any substring of at least 3 characters
+    if not _table_exists(cur, "note_fts"):
+        try:
+            cur.execute(
+                """
+                CREATE VIRTUAL TABLE "note_fts" USING fts5(
+                    label,
+                    body,
+                    content='note',
+                    content_rowid='id',
+                    tokenize='trigram'
+                )
+                """
+            )
+        except sqlite3.OperationalError:
+            # SQLite older than 3.34 has no trigram tokenizer, or is built
+            # without FTS5: notes are searched with LIKE instead
+            return
+
+        _start_backfill(cur, "note_fts")
+
+    # Removing a note not indexed yet would corrupt the index
+    _create_fts_triggers(
+        cur,
+        migrated=""
+        if _progress(cur, "note_fts") is None
+        else """
+        WHEN {row}.id <= (
+            SELECT after FROM migration_progress WHERE name = 'note_fts'
+        )
+        """,
+    )
+
+
+def _index_note_text(cur, limit):
+    ids = _backfill_ids(
+        cur, "note_fts", "SELECT id FROM note WHERE id > ? ORDER BY id LIMIT ?", limit
+    )
+    if ids is None:
+        return False
+
+    cur.execute(
+        """
+        INSERT INTO note_fts(rowid, label, body)
+        SELECT id, label, body FROM note WHERE id > ? AND id <= ?
+        """,
+        ids,
+    )
+    return True
+
+
+def _finish_fts(cur):
+    if _finish_backfill(cur, "note_fts"):
+        for _ in ("insert", "delete", "update"):
+            cur.execute(f'DROP TRIGGER IF EXISTS "note_fts_{_}"')
+        _create_fts_triggers(cur)
+
+
+def _track_changes(cur):
+    # Each write to a note takes the next value of a sequence shared by all
+    # notes, and deleted notes leave a tombstone, see Database.get_changes
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "sequence" (
+            "name" TEXT NOT NULL,
+            "value" INTEGER NOT NULL,
+            PRIMARY KEY("name")
+        ) WITHOUT ROWID
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "note_tombstone" (
+            "id" INTEGER NOT NULL,
+            "seq" INTEGER NOT NULL,
+            PRIMARY KEY("id")
+        )
+        """
+    )
+    if not any(_["name"] == "seq" for _ in cur.query('PRAGMA table_info("note")')):
+        cur.execute('ALTER TABLE note ADD COLUMN "seq" INTEGER NOT NULL DEFAULT 0')
+        _start_backfill(cur, "note_seq")
+
+    # Start after ids, that existing notes are numbered by
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO sequence (name, value)
+        SELECT 'note', MAX(IFNULL(MAX(seq), 0), IFNULL(MAX(id), 0)) FROM note
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "note_seq_insert"
+        AFTER INSERT ON note BEGIN
+            UPDATE sequence SET value = value + 1 WHERE name = 'note';
+            UPDATE note
+            SET seq = (SELECT value FROM sequence WHERE name = 'note')
+            WHERE id = new.id;
+            DELETE FROM note_tombstone WHERE id = new.id;
+        END
+        """
+    )
+
+    # Tags are only written along with their note
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "note_seq_update"
+        AFTER UPDATE OF label, author, body ON note BEGIN
+            UPDATE sequence SET value = value + 1 WHERE name = 'note';
+            UPDATE note
+            SET seq = (SELECT value FROM sequence WHERE name = 'note')
+            WHERE id = new.id;
+        END
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS "note_seq_delete"
+        AFTER DELETE ON note BEGIN
+            UPDATE sequence SET value = value + 1 WHERE name = 'note';
+            INSERT OR REPLACE INTO note_tombstone (id, seq)
+            VALUES (old.id, (SELECT value FROM sequence WHERE name = 'note'));
+        END
+        """
+    )
+
+    # Only reindex text when it changes, not when seq does
+    if not _table_exists(cur, "note_fts"):
+        return
+
+    cur.execute('DROP TRIGGER IF EXISTS "note_fts_update"')
+    cur.execute(
+        """
+        CREATE TRIGGER "note_fts_update"
+        AFTER UPDATE OF label, body ON note BEGIN
+            INSERT INTO note_fts(note_fts, rowid, label, body)
+            VALUES ('delete', old.id, old.label, old.body);
+            INSERT INTO note_fts(rowid, label, body)
+            VALUES (new.id, new.label, new.body);
+        END
+        """
+    )
+
+
+def _number_notes(cur, limit):
+    ids = _backfill_ids(
+        cur, "note_seq", "SELECT id FROM note WHERE id > ? ORDER BY id LIMIT ?", limit
+    )
+    if ids is None:
+        return False
+
+    # Existing notes are numbered by id, as if created in that order. Notes
+    # written meanwhile already have a seq
+    cur.execute("UPDATE note SET seq = id WHERE id > ? AND id <= ? AND seq = 0", ids)
+    return True
+
+
+def _index_changes(cur):
+    _finish_backfill(cur, "note_seq")
+    cur.execute('CREATE INDEX IF NOT EXISTS "note_seq" ON note("seq")')
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS "note_tombstone_seq"
+        ON note_tombstone("seq")
+        """
+    )
+
+
+# Version N of the schema is reached by applying the N first steps
+MIGRATIONS = [
+    Migration("Create notes and tags", _create_notes),
+    Migration(
+        "Count notes per tag",
+        _count_tags,
+        backfill=_count_note_tags,
+        finish=_finish_tags,
+    ),
+    Migration(
+        "Index notes for sorting and full-text search",
+        _index_notes,
+        backfill=_index_note_text,
+        finish=_finish_fts,
+    ),
+    Migration(
+        "Track changes of notes for sync",
+        _track_changes,
+        backfill=_number_notes,
+        finish=_index_changes,
+    ),
+]
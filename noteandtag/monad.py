@@ -1,11 +1,90 @@
-__all__ = ["Database"]
-import yaml
+__all__ = [
+    "Database",
+    "AsyncDatabase",
+    "Generation",
+    "BatchError",
+    "InvalidFilter",
+    "is_valid_note",
+]
+import asyncio
+import copy
+import ctypes
+import json
+import multiprocessing
+import queue
+import time
 import shutil
-import os
+import sys
 import tempfile
 import sqlite3
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import wraps
 from typing import List, Dict, Any
+from noteandtag import metrics, slowlog
+from noteandtag.feed import ChangeFeed
+from noteandtag.migrations import MIGRATIONS
+
+DEFAULT_WORKERS = 4
+# Seconds to wait for a lock held by another connection or process
+BUSY_TIMEOUT = 30.0
+# Shortest search term the trigram full-text index can match
+FTS_MIN_LENGTH = 3
+# Max number of variables bound in a single IN (...)
+MAX_VARIABLES = 500
+# Number of items per page
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 50
+# Max number of items per page when streaming results
+MAX_STREAM_LIMIT = 10000
+# Number of rows fetched at once when streaming results
+STREAM_CHUNK_SIZE = 500
+# Number of chunks waiting to be sent when streaming results
+STREAM_QUEUE_SIZE = 2
+# Seconds to wait for a client to read a chunk before aborting a stream, so
+# that stalled clients can't hold threads of the pool
+STREAM_TIMEOUT = 30.0
+# Seconds to wait for more writes before committing a batch
+COMMIT_INTERVAL = 0.0
+# Max number of writes committed in a single transaction
+COMMIT_BATCH_SIZE = 100
+# Number of rows migrated per transaction by online migrations
+BACKFILL_BATCH_SIZE = 1000
+# Operations allowed in a batch
+BATCH_OPERATIONS = ("get", "create", "update", "delete")
+# Fields of notes, seq is only returned when syncing
+NOTE_COLUMNS = "note.id, note.label, note.author, note.body"
+# Types of the fields notes and tags are sorted by, that cursors must match
+NOTE_KEY_TYPES = {"id": int, "label": str, "author": str}
+TAG_KEY_TYPES = {"name": str, "total": int}
+
+
+class BatchError(ValueError):
+    """Raised when an operation of an atomic batch fails.
+
+    :param index: index of the failing operation
+    :param cause: exception raised by the operation, or `None` if not found
+    """
+
+    def __init__(self, index: int, cause: Exception = None):
+        super().__init__(
+            "operation {} failed: {}".format(index, cause or "note not found")
+        )
+        self.index = index
+        self.cause = cause
+
+
+class InvalidFilter(ValueError):
+    """Raised when a filter can't be applied to a query.
+
+    :param name: name of the invalid filter
+    """
+
+    def __init__(self, name: str):
+        super().__init__(f"invalid filter {name}")
+        self.name = name
 
 
 def _filtering(fun):
@@ -15,12 +94,19 @@ def _filtering(fun):
             value = filters.get(name, None) if filters else None
             return value if value is not None else default
 
+        stream = bool(get_attr("stream", False))
+
         return fun(
             *args,
             filters={
                 "offset": int(get_attr("offset", 0)),
-                "limit": min(int(get_attr("limit", 50)), 50),
+                "limit": min(
+                    int(get_attr("limit", DEFAULT_LIMIT)),
+                    MAX_STREAM_LIMIT if stream else MAX_LIMIT,
+                ),
                 "sort": get_attr("sort", []),
+                "after": get_attr("after", None),
+                "stream": stream,
             },
             **kwargs,
         )
@@ -28,6 +114,216 @@ def _filtering(fun):
     return wrapper
 
 
+def _seek(order, after, types):
+    """Build a condition selecting rows that come after a key.
+
+    When all columns are sorted in the same direction, this is a row value
+    comparison SQLite turns into an index range:
+
+    .. code-block:: python
+
+        (a, b) > (?, ?)
+
+    Otherwise the first column still bounds the range:
+
+    .. code-block:: python
+
+        a >= ? AND ((a > ?) OR (a = ? AND b < ?))
+
+    :param order: list of (column, descending) the rows are sorted by
+    :param after: values of columns for the last row of previous page
+    :param types: types of values, as cursors come from clients
+    :return: a tuple (condition, args)
+    """
+    if not isinstance(after, list) or len(after) != len(order):
+        raise InvalidFilter("after")
+    # Exact types, as bool is an int and JSON objects can't be bound
+    if any(type(_) is not __ for _, __ in zip(after, types)):
+        raise InvalidFilter("after")
+
+    directions = set(_ for __, _ in order)
+    if len(directions) == 1:
+        return (
+            "({}) {} ({})".format(
+                ", ".join(_ for _, __ in order),
+                "<" if directions.pop() else ">",
+                ", ".join("?" * len(order)),
+            ),
+            list(after),
+        )
+
+    conditions = []
+    args = []
+    for i, (column, descending) in enumerate(order):
+        conditions.append(
+            "({})".format(
+                " AND ".join(
+                    [f"{_} = ?" for _, __ in order[:i]]
+                    + ["{} {} ?".format(column, "<" if descending else ">")]
+                )
+            )
+        )
+        args.extend(after[: i + 1])
+
+    column, descending = order[0]
+    return (
+        "{} {} ? AND ({})".format(
+            column, "<=" if descending else ">=", " OR ".join(conditions)
+        ),
+        [after[0]] + args,
+    )
+
+
+def _sort_order(sort, columns, key):
+    """Map sort filters to the columns rows are sorted by.
+
+    Rows are always sorted by the unique `key` last so that the order is
+    stable across pages. It takes the direction of the previous column, so
+    that an index on that column, which implicitly ends with the rowid,
+    can be read backwards instead of sorting rows.
+
+    :param sort: list of {"field": ..., "order": "asc" or "desc"}
+    :param columns: fields allowed for sorting, mapped to their column
+    :param key: unique field
+    :return: a tuple (order, fields) with order a list of (column, descending)
+    """
+    order = []
+    fields = []
+    for _ in sort:
+        if _["field"] not in columns or _["field"] in fields:
+            raise InvalidFilter("sortBy")
+
+        order.append((columns[_["field"]], _["order"] == "desc"))
+        fields.append(_["field"])
+
+    if key not in fields:
+        order.append((columns[key], order[-1][1] if order else False))
+        fields.append(key)
+
+    return order, fields
+
+
+def _order_by(order):
+    """Build an ORDER BY clause from a list of (column, descending)."""
+    return ", ".join("{} {}".format(_, "DESC" if __ else "ASC") for _, __ in order)
+
+
+def _last_key(items, keys, limit):
+    """Get the key of last item if there may be a next page.
+
+    :param items: items of current page
+    :param keys: fields the items are sorted by
+    :param limit: max number of items per page
+    :return: list of values or None
+    """
+    if not items or len(items) < limit:
+        return None
+
+    return [items[-1][_] for _ in keys]
+
+
+def _prefix_range(prefix):
+    """Get the range of strings starting with a prefix.
+
+    SQLite compares text as UTF-8 bytes, which sorts like code points, so
+    the upper bound is the prefix with its last code point incremented.
+
+    :param prefix: non-empty prefix
+    :return: a tuple (lower, upper) with upper `None` if unbounded
+    """
+    stripped = prefix.rstrip(chr(sys.maxunicode))
+    if not stripped:
+        return prefix, None
+
+    code = ord(stripped[-1]) + 1
+    # Surrogates can't be encoded, skip them
+    if 0xD800 <= code <= 0xDFFF:
+        code = 0xE000
+    return prefix, stripped[:-1] + chr(code)
+
+
+def _chunks(items, size=MAX_VARIABLES):
+    """Split a list to not exceed the number of variables in a statement."""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _copy_note(data):
+    # Deep copy with only plain types, this runs in the single writer thread
+    # so it must be cheap
+    return json.loads(json.dumps(data))
+
+
+def is_valid_note(data):
+    """Check a note has all required fields with the right types."""
+    return (
+        isinstance(data, dict)
+        and (data.get("id") is None or isinstance(data["id"], int))
+        and all(isinstance(data.get(_), str) for _ in ("label", "author", "body"))
+        and isinstance(data.get("tags"), list)
+        and all(isinstance(_, str) for _ in data["tags"])
+    )
+
+
+class Generation:
+    """Counter incremented after each write to DB.
+
+    By default it only counts writes done by this process. Create it with
+    `shared=True` before forking worker processes so that they all count
+    the writes of each other and agree on ETags. Each worker then gets its
+    own view with :meth:`worker`.
+
+    The counter is the sum of one slot per worker, only incremented by that
+    worker, so that no lock is shared between processes: a worker killed
+    while holding it would block all the others.
+
+    :param shared: whether the counter is shared with forked processes
+    :param workers: number of worker processes when shared
+    """
+
+    def __init__(self, *, shared: bool = False, workers: int = 1):
+        # Unique to this counter so that restarting never reuses an ETag
+        self.instance = uuid.uuid4().hex[:16]
+        if shared:
+            self._slots = multiprocessing.RawArray(ctypes.c_uint64, workers)
+        else:
+            self._slots = (ctypes.c_uint64 * 1)()
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def worker(self, index: int) -> "Generation":
+        """Get a view of the counter for a worker process.
+
+        A restarted worker takes the index of the one it replaces, and
+        keeps incrementing its slot.
+
+        :param index: index of the worker
+        :return: counter incrementing the slot of this worker
+        """
+        if not 0 <= index < len(self._slots):
+            raise IndexError(f"no slot for worker {index}")
+
+        generation = copy.copy(self)
+        generation._index = index
+        generation._lock = threading.Lock()
+        return generation
+
+    @property
+    def value(self) -> int:
+        # Slots only grow, so the sum never goes back even if they are read
+        # while other workers increment theirs
+        return sum(self._slots)
+
+    def increment(self) -> int:
+        """Increment the counter.
+
+        :return: new value, identifying the write just committed
+        """
+        with self._lock:
+            self._slots[self._index] += 1
+            return sum(self._slots)
+
+
 class _CursorContext:
     def __init__(self, conn):
         self._conn = conn
@@ -36,93 +332,265 @@ class _CursorContext:
         self._cur = self._conn.cursor()
         return self
 
-    def __exit__(self, *args, **kwargs):
-        pass
+    def __exit__(self, exc_type, *args, **kwargs):
+        # All statements run in the context are committed at once
+        if exc_type is None:
+            self._conn.commit()
+        else:
+            self._conn.rollback()
+
+    def _execute(self, stmt, args, *, many=False):
+        if many:
+            self._cur.executemany(stmt, args)
+        else:
+            self._cur.execute(stmt, args or [])
+
+    @contextmanager
+    def _timed(self, stmt, args, *, many=False):
+        """Time a statement, including fetching its rows."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            metrics.observe_query(duration)
+        slowlog.observe(self._conn, stmt, args, duration, many=many)
+
+    def _columns(self):
+        """Get column names of last query.
+
+        Rows are fetched as plain tuples and converted to dicts with this
+        list, read once per query instead of once per row.
+        """
+        return [_[0] for _ in self._cur.description]
 
     def query(self, stmt, args=None):
-        self._cur.execute(stmt, args or [])
-        return self._cur.fetchall()
+        with self._timed(stmt, args):
+            self._execute(stmt, args)
+            columns = self._columns()
+            rows = self._cur.fetchall()
+        return [dict(zip(columns, _)) for _ in rows]
+
+    def iterate(self, stmt, args=None, *, size=STREAM_CHUNK_SIZE):
+        """Iterate over rows by chunks of `size` instead of fetching all.
+
+        Only running the statement is timed, as fetching rows waits for
+        the consumer.
+        """
+        with self._timed(stmt, args):
+            self._execute(stmt, args)
+        columns = self._columns()
+        while True:
+            rows = self._cur.fetchmany(size)
+            if not rows:
+                return
+
+            yield [dict(zip(columns, _)) for _ in rows]
 
     def query_row(self, stmt, args=None):
-        self._cur.execute(stmt, args or [])
-        return self._cur.fetchone()
+        with self._timed(stmt, args):
+            self._execute(stmt, args)
+            row = self._cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(self._columns(), row))
 
     def query_value(self, stmt, args=None):
-        self._cur.execute(stmt, args or [])
-        row = self._cur.fetchone()
+        with self._timed(stmt, args):
+            self._execute(stmt, args)
+            row = self._cur.fetchone()
         if row is None:
             return None
-        for k, v in row.items():
-            return v
-        return None
+        return row[0]
 
     def execute(self, stmt, args=None):
-        self._cur.execute(stmt, args or [])
-        self._conn.commit()
+        with self._timed(stmt, args):
+            self._execute(stmt, args)
+
+    def execute_many(self, stmt, args):
+        with self._timed(stmt, args, many=True):
+            self._execute(stmt, args, many=True)
+
+    def begin(self):
+        """Start a transaction locking DB for writing."""
+        with self._timed("BEGIN IMMEDIATE", None):
+            self._execute("BEGIN IMMEDIATE", None)
 
     @property
     def lastrowid(self):
         return self._cur.lastrowid
 
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
 
 class Database:
-    def __init__(self, filename: str):
+    """Synchronous access to the SQLite database.
+
+    Each thread gets its own connection, so a single instance can be
+    shared by the worker threads of :class:`AsyncDatabase`.
+
+    :param filename: path to SQLite database
+    :param generation: counter of writes, shared by worker processes
+    :param migrate: migrate database to the last version of its schema
+    """
+
+    def __init__(
+        self, filename: str, *, generation: Generation = None, migrate: bool = True
+    ):
         self._filename = filename
-        self._conn = None
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+        self._generation = generation or Generation()
+        # Whether notes have a full-text index, see _search_notes
+        self._fts = None
+
+        if migrate:
+            self.migrate()
 
+    @property
+    def generation(self) -> int:
+        """Counter incremented after each write to DB."""
+        return self._generation.value
+
+    @property
+    def etag(self) -> str:
+        """ETag changing each time DB is modified.
+
+        Writes from processes not sharing the generation, such as the
+        `import` command, are seen through the sequence numbering changes
+        of notes, see :meth:`get_changes`.
+
+        Read it before querying DB: a write committed meanwhile will then
+        only cause a spurious cache miss, never a stale cache hit.
+        """
+        generation = self._generation.value
         with self._cursor() as cur:
-            cur.query("SELECT * FROM note")
+            seq = cur.query_value("SELECT value FROM sequence WHERE name = 'note'")
 
-    @staticmethod
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+        return '"{}-{}-{}"'.format(self._generation.instance, generation, seq)
+
+    @contextmanager
+    def _transaction(self):
+        """Run statements in a single write transaction.
+
+        The generation is incremented once the transaction is committed.
+        """
+        with self._cursor() as cur:
+            cur.begin()
+            yield cur
+
+        self._generation.increment()
+
+    def _full_text(self):
+        """Check whether notes have a full-text index.
+
+        SQLite older than 3.34 can't create it, see
+        :data:`noteandtag.migrations.MIGRATIONS`.
+        """
+        if self._fts is None:
+            with self._cursor() as cur:
+                self._fts = bool(
+                    cur.query_value(
+                        "SELECT name FROM sqlite_master"
+                        " WHERE type='table' AND name='note_fts'"
+                    )
+                )
+
+        return self._fts
 
     def _cursor(self):
-        if self._conn is None:
-            self._conn = Database._connect(self._filename)
-            self._conn.row_factory = Database.dict_factory
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            with self._lock:
+                conn = Database._connect(self._filename)
+                self._conns.append(conn)
+            self._local.conn = conn
 
-        return _CursorContext(self._conn)
+        return _CursorContext(conn)
 
     @staticmethod
     def _connect(filename):
-        found = os.path.isfile(filename)
+        # Connections are only closed from another thread by close(). Writers
+        # from other threads or processes wait for each other up to timeout.
+        conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Commits are durable once they return, see AsyncDatabase for batching
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def close(self):
+        """Close all connections opened by this instance."""
+        with self._lock:
+            for _ in self._conns:
+                _.close()
+            self._conns = []
+        self._local = threading.local()
+
+    """Migrate database to the last version of its schema.
+
+    Each missing step of :data:`noteandtag.migrations.MIGRATIONS` runs in
+    its own transaction, that also updates `PRAGMA user_version`, so an
+    interrupted migration resumes from the last completed step.
+
+    Offline, existing rows are migrated in the same transaction as the
+    schema. Online, they are migrated by transactions of `batch_size` rows,
+    so that writers from other processes are not blocked while counting
+    tags, indexing text and numbering notes. Creating indexes still holds
+    the write lock until each index is built. Readers are never blocked, as
+    DB uses WAL.
+    :param online: migrate rows by batches
+    :param batch_size: number of rows migrated per transaction when online
+    :return: version of database
+    """
 
-        conn = sqlite3.connect(filename)
+    def migrate(self, *, online: bool = False, batch_size: int = None) -> int:
+        with self._cursor() as cur:
+            version = cur.query_value("PRAGMA user_version")
+        if version > len(MIGRATIONS):
+            raise RuntimeError(
+                f"database version {version} is newer than {len(MIGRATIONS)}"
+            )
 
-        if not found:
-            Database._setup(conn=conn)
+        batch_size = batch_size or BACKFILL_BATCH_SIZE
+        for version, migration in enumerate(MIGRATIONS[version:], version + 1):
+            with self._transaction() as cur:
+                # Another process may have migrated DB meanwhile
+                if cur.query_value("PRAGMA user_version") >= version:
+                    continue
 
-        return conn
+                migration.schema(cur)
+                if not online:
+                    Database._backfill(cur, migration, batch_size)
+                    Database._finish(cur, migration, version)
+                    continue
+
+            more = migration.backfill is not None
+            while more:
+                with self._transaction() as cur:
+                    more = migration.backfill(cur, batch_size)
+
+            with self._transaction() as cur:
+                if cur.query_value("PRAGMA user_version") < version:
+                    Database._finish(cur, migration, version)
+
+        self._fts = None
+        return len(MIGRATIONS)
 
     @staticmethod
-    def _setup(conn):
-        with _CursorContext(conn) as cur:
-            cur.execute(
-                """
-                CREATE TABLE "note" (
-                    "id" INTEGER NOT NULL,
-                    "label"	TEXT NOT NULL,
-                    "author" TEXT NOT NULL,
-                    "body" TEXT NOT NULL,
-                    PRIMARY KEY("id" AUTOINCREMENT)
-                )
-                """
-            )
+    def _backfill(cur, migration, batch_size):
+        if migration.backfill is not None:
+            while migration.backfill(cur, batch_size):
+                pass
 
-            cur.execute(
-                """
-                CREATE TABLE "note_tag" (
-                    "noteid" INTEGER NOT NULL,
-                    "label" TEXT NOT NULL,
-                    PRIMARY KEY("noteid", "label"),
-                    FOREIGN KEY("noteid") REFERENCES note("id")
-                )
-                """
-            )
+    @staticmethod
+    def _finish(cur, migration, version):
+        if migration.finish is not None:
+            migration.finish(cur)
+        # Pragmas can't take parameters, version is always an int
+        cur.execute(f"PRAGMA user_version = {int(version)}")
 
     """Get a list of notes matching multiple filters.
 
@@ -132,7 +600,10 @@ class Database:
     :param label: only notes matching this label
     :param body: only notes matching this body
     :param tags: only notes matching those tags
-    :return: a tuple (notes, total)
+    :return: a tuple (notes, total, after) with after the key to get next page
+
+    When streaming, notes are a generator of chunks that must be consumed
+    from a single thread, and after is `None`.
     """
 
     @_filtering
@@ -148,7 +619,7 @@ class Database:
         # Fetch notes by ids only
         if ids:
             notes = self._get_notes_by_ids(ids)
-            return notes, len(notes)
+            return notes, len(notes), None
 
         # Fetch all notes
         return self._search_notes(filters=filters, label=label, body=body, tags=tags)
@@ -161,7 +632,25 @@ class Database:
     """
 
     def _get_notes_by_ids(self, ids):
-        return [_ for _ in (self.get_note_by_id(_) for _ in ids) if _]
+        with self._cursor() as cur:
+            notes = {}
+            for chunk in _chunks(list(dict.fromkeys(ids))):
+                for _ in cur.query(
+                    """
+                    SELECT {}
+                    FROM note
+                    WHERE id IN ({})
+                    """.format(
+                        NOTE_COLUMNS, ", ".join("?" * len(chunk))
+                    ),
+                    chunk,
+                ):
+                    notes[_["id"]] = _
+
+            self._fetch_tags(cur, notes.values())
+
+        # Keep the order of ids
+        return [notes[_] for _ in ids if _ in notes]
 
     """Get a list of notes matching multiple filters.
 
@@ -169,19 +658,35 @@ class Database:
 
     .. code-block:: python
 
-        SELECT *
+        SELECT note.*
         FROM note
-        WHERE label LIKE '%...%'
-        AND body LIKE '%...%'
+        JOIN note_fts ON note_fts.rowid = note.id
+        WHERE note_fts MATCH 'label : "..." AND body : "..."'
+        AND note.id IN (
+            SELECT noteid
+            FROM note_tag
+            WHERE label IN (...)
+            GROUP BY noteid
+            HAVING COUNT(*) = len(tags)
+        )
+        ORDER BY sort fields, note.id
         LIMIT offset, limit
 
-    Notes are filtered by tags afterward.
+    Notes can be sorted by `id`, `label` and `author`, or by `rank` when
+    searching by label or body.
+
+    Search terms shorter than 3 characters can't use the full-text index
+    and fallback to a `LIKE '%...%'` scan, as do all terms when SQLite is
+    too old to have built the index.
+
+    When `after` is given, notes are selected from the key of last note of
+    previous page instead of skipping `offset` notes.
 
     :param filters: pagination and sort filters
     :param label: only notes matching this label
     :param body: only notes matching this body
     :param tags: only notes matching those tags
-    :return: a tuple (notes, total)
+    :return: a tuple (notes, total, after)
     """
 
     def _search_notes(
@@ -192,89 +697,276 @@ class Database:
         body: str = None,
         tags: List[str] = None,
     ):
-        tags = tags if tags else []
+        tags = list(dict.fromkeys(tags)) if tags else []
         conditions = []
         args = []
+        matches = []
+
+        # Must contain a label and a body
+        for column, value in (("label", label), ("body", body)):
+            if value is None:
+                continue
+
+            if len(value) >= FTS_MIN_LENGTH and self._full_text():
+                matches.append('{} : "{}"'.format(column, value.replace('"', '""')))
+            else:
+                conditions.append(f"note.{column} LIKE ?")
+                args.append(f"%{value}%")
+
+        if matches:
+            conditions.insert(0, "note_fts MATCH ?")
+            args.insert(0, " AND ".join(matches))
+
+        # Must have all tags
+        if tags:
+            conditions.append(
+                """
+                note.id IN (
+                    SELECT noteid
+                    FROM note_tag
+                    WHERE label IN ({})
+                    GROUP BY noteid
+                    HAVING COUNT(*) = ?
+                )
+                """.format(
+                    ", ".join("?" * len(tags))
+                )
+            )
+            args.extend(tags)
+            args.append(len(tags))
 
-        # Must contain a label
-        if label is not None:
-            conditions.append("label LIKE ?")
-            args.append(f"%{label}%")
-
-        # Must contain a body
-        if body is not None:
-            conditions.append("body LIKE ?")
-            args.append(f"%{body}%")
+        # Sort by any field, or by best matches first
+        columns = {"id": "note.id", "label": "note.label", "author": "note.author"}
+        if matches:
+            columns["rank"] = "note_fts.rank"
+        order, keys = _sort_order(filters["sort"], columns, "id")
+        if "rank" in keys:
+            keys = None
 
         stmt = """
             FROM note
             {}
+            {}
+        """.format(
+            "JOIN note_fts ON note_fts.rowid = note.id" if matches else "",
+            "WHERE {}".format(" AND ".join(conditions)) if conditions else "",
+        )
+
+        # Start after the last note of previous page
+        seek_stmt = stmt
+        seek_args = args
+        offset = filters["offset"]
+        if filters["after"] is not None:
+            if keys is None:
+                raise InvalidFilter("after")
+
+            condition, seek_args = _seek(
+                order, filters["after"], [NOTE_KEY_TYPES[_] for _ in keys]
+            )
+            seek_stmt = "{} {} {}".format(
+                stmt, "AND" if conditions else "WHERE", condition
+            )
+            seek_args = args + seek_args
+            offset = 0
+
+        page_stmt = """
+            SELECT {}
+            {}
+            ORDER BY {}
+            LIMIT ?, ?
         """.format(
-            "WHERE {}".format(" AND ".join(conditions)) if conditions else ""
+            NOTE_COLUMNS, seek_stmt, _order_by(order)
         )
+        page_args = seek_args + [offset, filters["limit"]]
 
         with self._cursor() as cur:
             total = cur.query_value(
                 """
-                SELECT COUNT(id)
+                SELECT COUNT(note.id)
                 {}
                 """.format(
                     stmt
                 ),
                 args,
             )
+            if filters["stream"]:
+                return (
+                    self._stream(page_stmt, page_args, Database._fetch_tags),
+                    total,
+                    None,
+                )
 
-            notes = cur.query(
-                """
-                SELECT *
-                {}
-                LIMIT ?, ?
-                """.format(
-                    stmt
-                ),
-                args + [filters["offset"], filters["limit"]],
+            notes = cur.query(page_stmt, page_args)
+            self._fetch_tags(cur, notes)
+
+        return notes, total, keys and _last_key(notes, keys, filters["limit"])
+
+    """Get a list of tags with the number of notes having them.
+
+    Counts are read from the `tag` table, so this is an index range scan
+    whatever the sort order.
+
+    With a `prefix`, only tags starting with it are read from a range of the
+    primary key, and they are sorted by `total` first by default so that the
+    first page holds the most used ones, as expected for autocompletion.
+
+    Tags can be sorted by `name` and `total`.
+    :param filters: pagination and sort filters
+    :param prefix: only tags starting with this text (case sensitive)
+    :return: a tuple (tags, total, after)
+    """
+
+    @_filtering
+    def get_tags(self, *, filters, prefix: str = None):
+        sort = filters["sort"]
+        if prefix and not sort:
+            sort = [{"field": "total", "order": "desc"}]
+        order, keys = _sort_order(sort, {"name": "label", "total": "total"}, "name")
+
+        # Only tags in the range of prefix
+        conditions = []
+        args = []
+        if prefix:
+            lower, upper = _prefix_range(prefix)
+            conditions.append("label >= ?")
+            args.append(lower)
+            if upper is not None:
+                conditions.append("label < ?")
+                args.append(upper)
+        count_stmt = "SELECT COUNT(label) FROM tag {}".format(
+            "WHERE " + " AND ".join(conditions) if conditions else ""
+        )
+        count_args = list(args)
+
+        # Start after the last tag of previous page
+        offset = filters["offset"]
+        if filters["after"] is not None:
+            condition, after_args = _seek(
+                order, filters["after"], [TAG_KEY_TYPES[_] for _ in keys]
             )
+            conditions.append(f"({condition})")
+            args.extend(after_args)
+            offset = 0
+
+        page_stmt = """
+            SELECT label AS name, total
+            FROM tag
+            {}
+            ORDER BY {}
+            LIMIT ?, ?
+        """.format(
+            "WHERE " + " AND ".join(conditions) if conditions else "",
+            _order_by(order),
+        )
+        page_args = args + [offset, filters["limit"]]
 
-        # Fetch tags
-        for _ in notes:
-            _["tags"] = self.get_note_tags(_["id"])
+        with self._cursor() as cur:
+            total = cur.query_value(count_stmt, count_args)
+            if filters["stream"]:
+                return self._stream(page_stmt, page_args), total, None
+
+            items = cur.query(page_stmt, page_args)
+
+        return items, total, _last_key(items, keys, filters["limit"])
 
-        # Keep only notes matching tags
-        size = len(notes)
-        notes = [_ for _ in notes if all(tag in _["tags"] for tag in tags)]
-        total -= size - len(notes)
+    """Get notes changed or deleted after a sequence value, in order.
 
-        return notes, total
+    Changed notes are returned with their `seq`, deleted ones only with
+    their `id`, `seq` and `deleted` set to `true`. Clients store the `seq`
+    of the last item to ask for the next changes. Both lists are read by
+    ranges of indexes on `seq`.
+
+    :param filters: pagination filters, changes can't be sorted
+    :param since: only changes with a greater sequence value
+    :return: a tuple (changes, total, after)
+    """
 
     @_filtering
-    def get_tags(self, *, filters):
-        stmt = """
-            FROM note_tag
-            GROUP BY label
-        """
+    def get_changes(self, *, filters, since: int = 0):
+        if filters["sort"]:
+            raise InvalidFilter("sortBy")
+
+        # Start after the last change of previous page
+        offset = filters["offset"]
+        after = since
+        if filters["after"] is not None:
+            if len(filters["after"]) != 1 or not isinstance(filters["after"][0], int):
+                raise InvalidFilter("after")
+            after = max(since, filters["after"][0])
+            offset = 0
+
+        page_stmt = """
+            SELECT {}, note.seq, 0 AS deleted
+            FROM note
+            WHERE note.seq > ?
+            UNION ALL
+            SELECT id, NULL, NULL, NULL, seq, 1
+            FROM note_tombstone
+            WHERE seq > ?
+            ORDER BY seq
+            LIMIT ?, ?
+        """.format(
+            NOTE_COLUMNS
+        )
+        page_args = [after, after, offset, filters["limit"]]
 
         with self._cursor() as cur:
             total = cur.query_value(
                 """
-                SELECT COUNT(label)
-                {}
-                """.format(
-                    stmt
-                )
+                SELECT
+                    (SELECT COUNT(*) FROM note WHERE seq > ?)
+                    + (SELECT COUNT(*) FROM note_tombstone WHERE seq > ?)
+                """,
+                (since, since),
             )
+            if filters["stream"]:
+                return (
+                    self._stream(page_stmt, page_args, Database._fetch_changes),
+                    total,
+                    None,
+                )
 
-            items = cur.query(
-                """
-                SELECT label AS name, COUNT(noteid) AS total
-                {}
-                LIMIT ?, ?
-                """.format(
-                    stmt
-                ),
-                (filters["offset"], filters["limit"]),
-            )
+            changes = cur.query(page_stmt, page_args)
+            self._fetch_changes(cur, changes)
+
+        return changes, total, _last_key(changes, ["seq"], filters["limit"])
+
+    """Fetch tags of changed notes and strip deleted ones.
 
-        return items, total
+    :param cur: cursor to database
+    :param changes: list of changes
+    """
+
+    @staticmethod
+    def _fetch_changes(cur, changes):
+        notes = []
+        for _ in changes:
+            if _.pop("deleted"):
+                for field in ("label", "author", "body"):
+                    del _[field]
+                _["deleted"] = True
+            else:
+                notes.append(_)
+
+        Database._fetch_tags(cur, notes)
+
+    """Iterate over the rows of a query by chunks.
+
+    Nothing is queried until the first chunk is requested, and all chunks
+    must then be requested from the same thread.
+    :param stmt: query
+    :param args: query parameters
+    :param hydrate: function called with a cursor and each chunk
+    :return: generator of chunks
+    """
+
+    def _stream(self, stmt, args, hydrate=None):
+        with self._cursor() as cur, self._cursor() as other:
+            for rows in cur.iterate(stmt, args):
+                if hydrate:
+                    hydrate(other, rows)
+
+                yield rows
 
     """Get a single note by id.
     :param id: note id
@@ -283,21 +975,52 @@ class Database:
 
     def get_note_by_id(self, id):
         with self._cursor() as cur:
-            data = cur.query_row(
-                """
-                SELECT *
-                FROM note
-                WHERE id=?
-                """,
-                (id,),
-            )
+            return Database._get_note(cur, id)
 
+    @staticmethod
+    def _get_note(cur, id):
+        data = cur.query_row(
+            """
+            SELECT {}
+            FROM note
+            WHERE id=?
+            """.format(
+                NOTE_COLUMNS
+            ),
+            (id,),
+        )
         if not data:
             return None
 
-        data["tags"] = self.get_note_tags(id)
+        Database._fetch_tags(cur, [data])
         return data
 
+    """Fetch tags of many notes at once.
+
+    Tags are stored in the `tags` field of each note.
+    :param cur: cursor to database
+    :param notes: list of notes
+    """
+
+    @staticmethod
+    def _fetch_tags(cur, notes):
+        notes = {_["id"]: _ for _ in notes}
+        for _ in notes.values():
+            _["tags"] = []
+
+        for chunk in _chunks(list(notes.keys())):
+            for _ in cur.query(
+                """
+                SELECT noteid, label
+                FROM note_tag
+                WHERE noteid IN ({})
+                """.format(
+                    ", ".join("?" * len(chunk))
+                ),
+                chunk,
+            ):
+                notes[_["noteid"]]["tags"].append(_["label"])
+
     def get_note_tags(self, id):
         with self._cursor() as cur:
             return [
@@ -332,55 +1055,88 @@ class Database:
             )
 
     """Update an existing note.
+
+    The note is updated in place and only added or removed tags are
+    written, all in a single transaction.
     :param id: note id
     :param data: new note data
     :return: updated note
     """
 
     def update_note(self, id, data):
-        data = yaml.safe_load(yaml.safe_dump(data))
+        data = _copy_note(data)
 
-        if not self.has_note(id):
+        with self._transaction() as cur:
+            return Database._update_note(cur, id, data)
+
+    @staticmethod
+    def _update_note(cur, id, data):
+        cur.execute(
+            """
+            UPDATE note
+            SET label=?, author=?, body=?
+            WHERE id=?
+            """,
+            (data["label"], data["author"], data["body"], id),
+        )
+        if cur.rowcount == 0:
             return None
 
-        self.delete_note(id)
-        return self.add_note(data, id=id)
+        data["id"] = id
+        data["tags"] = list(dict.fromkeys(data["tags"]))
+        old_tags = set(
+            _["label"]
+            for _ in cur.query("SELECT label FROM note_tag WHERE noteid=?", (id,))
+        )
+
+        cur.execute_many(
+            "DELETE FROM note_tag WHERE noteid=? AND label=?",
+            [(id, _) for _ in old_tags.difference(data["tags"])],
+        )
+        cur.execute_many(
+            "INSERT INTO note_tag (noteid, label) VALUES (?, ?)",
+            [(id, _) for _ in data["tags"] if _ not in old_tags],
+        )
+
+        return data
 
     """Add a new note to DB.
+
+    The note and its tags are written in a single transaction.
     :param data: new note data
     :param id: new note id
     :return: added note
     """
 
     def add_note(self, data, *, id=None):
-        data = yaml.safe_load(yaml.safe_dump(data))
+        data = _copy_note(data)
 
-        with self._cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO note
-                (id, label, author, body)
-                VALUES (?, ?, ?, ?)
-                """,
-                (
-                    None if id is None else id,
-                    data["label"],
-                    data["author"],
-                    data["body"],
-                ),
-            )
+        with self._transaction() as cur:
+            return Database._insert_note(cur, data, id=id)
 
-            data["id"] = cur.lastrowid if id is None else id
+    @staticmethod
+    def _insert_note(cur, data, *, id=None):
+        cur.execute(
+            """
+            INSERT INTO note
+            (id, label, author, body)
+            VALUES (?, ?, ?, ?)
+            """,
+            (
+                None if id is None else id,
+                data["label"],
+                data["author"],
+                data["body"],
+            ),
+        )
 
-            for _ in data["tags"]:
-                cur.execute(
-                    """
-                    INSERT INTO note_tag
-                    (noteid, label)
-                    VALUES (?, ?)
-                    """,
-                    (data["id"], _),
-                )
+        data["id"] = cur.lastrowid if id is None else id
+        data["tags"] = list(dict.fromkeys(data["tags"]))
+
+        cur.execute_many(
+            "INSERT INTO note_tag (noteid, label) VALUES (?, ?)",
+            [(data["id"], _) for _ in data["tags"]],
+        )
 
         return data
 
@@ -389,6 +1145,492 @@ class Database:
     """
 
     def delete_note(self, id):
+        with self._transaction() as cur:
+            Database._delete_note(cur, id)
+
+    @staticmethod
+    def _delete_note(cur, id):
+        cur.execute("DELETE FROM note_tag WHERE noteid=?", (id,))
+        cur.execute("DELETE FROM note WHERE id=?", (id,))
+        return cur.rowcount > 0
+
+    """Apply many writes in a single transaction.
+
+    Each write runs in its own savepoint, so that a failing write is
+    rolled back alone without aborting the others.
+    :param writes: list of functions taking a cursor
+    :return: a tuple (results, generation) with results the list of values
+        returned by writes, or exceptions raised by failing ones, and
+        generation the value of the counter for this commit
+    """
+
+    def write_many(self, writes):
+        results = []
+        # Like _transaction, but keep the generation of this very commit
+        with self._cursor() as cur:
+            cur.begin()
+            for write in writes:
+                cur.execute("SAVEPOINT write")
+                try:
+                    results.append(write(cur))
+                except Exception as e:
+                    cur.execute("ROLLBACK TO write")
+                    results.append(e)
+                cur.execute("RELEASE write")
+
+        return results, self._generation.increment()
+
+    """Run many operations on notes in a single transaction.
+
+    Operations are dicts like `{"op": "update", "id": 1, "data": {...}}`
+    with `op` one of `get`, `create`, `update` and `delete`. Each one runs
+    in its own savepoint so that a failing one is rolled back alone, unless
+    `atomic` is set: a :class:`BatchError` then rolls back all of them.
+    :param operations: list of operations
+    :param atomic: whether all operations must succeed
+    :return: list of results, a note, `None` if not found, or the exception
+        raised by an invalid operation
+    """
+
+    def batch(self, operations, *, atomic=False):
+        with self._transaction() as cur:
+            return Database._batch(cur, operations, atomic=atomic)
+
+    @staticmethod
+    def _batch(cur, operations, *, atomic=False):
+        results = []
+        for i, operation in enumerate(operations):
+            cur.execute("SAVEPOINT operation")
+            try:
+                result = Database._run_operation(cur, operation)
+            except (ValueError, sqlite3.IntegrityError) as e:
+                cur.execute("ROLLBACK TO operation")
+                result = e
+            cur.execute("RELEASE operation")
+
+            if atomic and (result is None or isinstance(result, Exception)):
+                raise BatchError(i, result)
+            results.append(result)
+
+        return results
+
+    @staticmethod
+    def _run_operation(cur, operation):
+        op = operation.get("op") if isinstance(operation, dict) else None
+        if op not in BATCH_OPERATIONS:
+            raise ValueError("op must be one of {}".format(", ".join(BATCH_OPERATIONS)))
+
+        id = operation.get("id", None)
+        if (op != "create" or id is not None) and not isinstance(id, int):
+            raise ValueError("id must be an integer")
+
+        if op in ("create", "update"):
+            data = operation.get("data", None)
+            if not is_valid_note(data):
+                raise ValueError("invalid note")
+            data = _copy_note(data)
+
+        if op == "get":
+            return Database._get_note(cur, id)
+        if op == "create":
+            return Database._insert_note(cur, data, id=id)
+        if op == "update":
+            return Database._update_note(cur, id, data)
+        return {"id": id} if Database._delete_note(cur, id) else None
+
+    """Add many notes to DB in a single transaction.
+
+    Notes without id get a new one. Nothing is added if a note is invalid
+    or if one of the ids already exists.
+    :param notes: list of notes
+    :return: number of added notes
+    """
+
+    def import_notes(self, notes):
+        rows, tags = Database._prepare_import(notes)
+
+        # Lock DB for writing so new ids can't be taken meanwhile
+        with self._transaction() as cur:
+            return Database._import_notes(cur, rows, tags)
+
+    @staticmethod
+    def _prepare_import(notes):
+        """Validate notes and split them into rows and tags."""
+        rows = []
+        tags = []
+        for i, data in enumerate(notes):
+            if not is_valid_note(data):
+                raise ValueError(f"invalid note at index {i}")
+
+            rows.append([data.get("id"), data["label"], data["author"], data["body"]])
+            tags.append(data["tags"])
+
+        return rows, tags
+
+    @staticmethod
+    def _import_notes(cur, rows, tags):
+        next_id = cur.query_value(
+            """
+            SELECT MAX(
+                IFNULL((SELECT MAX(id) FROM note), 0),
+                IFNULL((SELECT seq FROM sqlite_sequence WHERE name='note'), 0)
+            )
+            """
+        )
+        next_id = max([next_id] + [_[0] for _ in rows if _[0] is not None])
+        for _ in rows:
+            if _[0] is None:
+                next_id += 1
+                _[0] = next_id
+
+        cur.execute_many(
+            """
+            INSERT INTO note
+            (id, label, author, body)
+            VALUES (?, ?, ?, ?)
+            """,
+            rows,
+        )
+        cur.execute_many(
+            """
+            INSERT OR IGNORE INTO note_tag
+            (noteid, label)
+            VALUES (?, ?)
+            """,
+            ((row[0], _) for row, labels in zip(rows, tags) for _ in labels),
+        )
+
+        return len(rows)
+
+    """Get a chunk of notes ordered by id.
+
+    :param after: only notes with a greater id
+    :param limit: max number of notes
+    :return: notes
+    """
+
+    def export_notes(self, *, after=0, limit=1000):
         with self._cursor() as cur:
-            cur.execute("DELETE FROM note_tag WHERE noteid=?", (id,))
-            cur.execute("DELETE FROM note WHERE id=?", (id,))
+            notes = cur.query(
+                """
+                SELECT {}
+                FROM note
+                WHERE id > ?
+                ORDER BY id
+                LIMIT ?
+                """.format(
+                    NOTE_COLUMNS
+                ),
+                (after, limit),
+            )
+
+            self._fetch_tags(cur, notes)
+
+        return notes
+
+
+class AsyncDatabase:
+    """Asynchronous facade over :class:`Database`.
+
+    Queries are dispatched to a bounded pool of threads, each one owning
+    its own connection, so that a slow query never blocks the event loop.
+
+    Writes are queued to a single writer thread instead, which commits all
+    pending writes in one transaction. A write is awaited until committed,
+    but concurrent writes share the cost of committing to disk.
+
+    :param filename: path to SQLite database
+    :param workers: number of threads in the pool
+    :param generation: counter of writes, shared by worker processes
+    :param commit_interval: seconds to wait for more writes before committing
+    :param commit_batch_size: max number of writes per transaction
+    :param feed: feed publishing changes once committed, or `None`
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        *,
+        workers: int = None,
+        generation: Generation = None,
+        commit_interval: float = None,
+        commit_batch_size: int = None,
+        feed: ChangeFeed = None,
+    ):
+        self._db = Database(filename, generation=generation)
+        self._feed = feed
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers or DEFAULT_WORKERS, thread_name_prefix="noteandtag-db"
+        )
+        self._commit_interval = (
+            COMMIT_INTERVAL if commit_interval is None else commit_interval
+        )
+        self._commit_batch_size = commit_batch_size or COMMIT_BATCH_SIZE
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="noteandtag-writer", daemon=True
+        )
+        self._writer.start()
+
+    async def etag(self) -> str:
+        """ETag changing each time DB is modified, see :attr:`Database.etag`.
+
+        It reads DB, so it runs on the pool instead of the event loop.
+        """
+        return await self._run(Database.etag.fget, self._db)
+
+    @property
+    def generation(self) -> int:
+        return self._db.generation
+
+    def _publish(self, type, data, *, generation):
+        if self._feed is not None:
+            self._feed.publish(type, data, generation=generation)
+
+    async def _run(self, fun, *args, **kwargs):
+        pending = metrics.DB_PENDING.labels(queue="pool")
+
+        def call():
+            pending.inc(-1)
+            with metrics.db_method(fun.__name__):
+                return fun(*args, **kwargs)
+
+        loop = asyncio.get_event_loop()
+        pending.inc()
+        return await loop.run_in_executor(self._executor, call)
+
+    async def _write(self, write, *, method):
+        """Queue a write and wait until it is committed.
+
+        :param write: function taking a cursor
+        :param method: name of the write for metrics
+        :return: a tuple (result, generation) with result the value returned
+            by `write` and generation the one of its commit
+        """
+        future = Future()
+        with metrics.DB_WRITE_DURATION.labels(method=method).time():
+            metrics.DB_PENDING.labels(queue="writer").inc()
+            self._writes.put((write, future))
+            result, generation = await asyncio.wrap_future(future)
+
+        # Even without events, the feed must know this commit is not from
+        # another process
+        if self._feed is not None:
+            self._feed.advance(generation)
+        if isinstance(result, Exception):
+            raise result
+        return result, generation
+
+    def _next_batch(self):
+        """Wait for pending writes, or `None` once closed."""
+        write = self._writes.get()
+        if write is None:
+            return None
+
+        batch = [write]
+        deadline = time.monotonic() + self._commit_interval
+        while len(batch) < self._commit_batch_size:
+            try:
+                write = self._writes.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if write is None:
+                # Stop after committing this batch
+                self._writes.put(None)
+                break
+
+            batch.append(write)
+
+        return batch
+
+    def _write_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            metrics.DB_PENDING.labels(queue="writer").inc(-len(batch))
+
+            # Skip writes whose caller is gone
+            batch = [_ for _ in batch if _[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                with metrics.db_method("write_many"):
+                    results, generation = self._db.write_many(
+                        [write for write, _ in batch]
+                    )
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            # Failing writes were committed along with others, see _write
+            for (_, future), result in zip(batch, results):
+                future.set_result((result, generation))
+
+    async def _iterate(self, chunks, *, method):
+        """Consume a generator from a single thread of the pool.
+
+        Chunks are sent back to the event loop through a bounded queue, so
+        the thread waits for the consumer instead of buffering everything.
+        If the consumer doesn't take a chunk within `STREAM_TIMEOUT`, the
+        thread stops and the consumer gets a `TimeoutError` instead.
+        :param chunks: generator of chunks
+        :param method: name of the Database method for metrics
+        :return: asynchronous generator of chunks
+        """
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(
+                asyncio.wait_for(queue.put(item), STREAM_TIMEOUT), loop
+            ).result()
+
+        def abort(e):
+            # Pending chunks are useless once the stream fails
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(e)
+
+        def produce():
+            try:
+                with metrics.db_method(method):
+                    for _ in chunks:
+                        if stopped.is_set():
+                            return
+
+                        put(_)
+                put(done)
+            except asyncio.TimeoutError:
+                if not stopped.is_set():
+                    loop.call_soon_threadsafe(
+                        abort, TimeoutError("client too slow to read stream")
+                    )
+            except Exception as e:
+                if not stopped.is_set():
+                    loop.call_soon_threadsafe(abort, e)
+            finally:
+                chunks.close()
+
+        loop.run_in_executor(self._executor, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                yield item
+        finally:
+            # Unblock the producer if consumer stopped early
+            stopped.set()
+            while not queue.empty():
+                queue.get_nowait()
+
+    async def get_notes(self, **kwargs):
+        items, total, after = await self._run(self._db.get_notes, **kwargs)
+        if not isinstance(items, list):
+            items = self._iterate(items, method="get_notes")
+
+        return items, total, after
+
+    async def get_changes(self, **kwargs):
+        items, total, after = await self._run(self._db.get_changes, **kwargs)
+        if not isinstance(items, list):
+            items = self._iterate(items, method="get_changes")
+
+        return items, total, after
+
+    async def get_tags(self, **kwargs):
+        items, total, after = await self._run(self._db.get_tags, **kwargs)
+        if not isinstance(items, list):
+            items = self._iterate(items, method="get_tags")
+
+        return items, total, after
+
+    async def get_note_by_id(self, id):
+        return await self._run(self._db.get_note_by_id, id)
+
+    async def get_note_tags(self, id):
+        return await self._run(self._db.get_note_tags, id)
+
+    async def has_note(self, id):
+        return await self._run(self._db.has_note, id)
+
+    async def update_note(self, id, data):
+        note, generation = await self._write(
+            lambda cur: Database._update_note(cur, id, _copy_note(data)),
+            method="update_note",
+        )
+        if note:
+            self._publish("note-updated", note, generation=generation)
+        return note
+
+    async def add_note(self, data, *, id=None):
+        note, generation = await self._write(
+            lambda cur: Database._insert_note(cur, _copy_note(data), id=id),
+            method="add_note",
+        )
+        if note:
+            self._publish("note-created", note, generation=generation)
+        return note
+
+    async def delete_note(self, id):
+        deleted, generation = await self._write(
+            lambda cur: Database._delete_note(cur, id), method="delete_note"
+        )
+        if deleted:
+            self._publish("note-deleted", {"id": id}, generation=generation)
+
+    async def batch(self, operations, *, atomic=False):
+        results, generation = await self._write(
+            lambda cur: Database._batch(cur, operations, atomic=atomic),
+            method="batch",
+        )
+        for operation, result in zip(operations, results):
+            if result is None or isinstance(result, Exception):
+                continue
+            if operation["op"] == "create":
+                self._publish("note-created", result, generation=generation)
+            elif operation["op"] == "update":
+                self._publish("note-updated", result, generation=generation)
+            elif operation["op"] == "delete":
+                self._publish("note-deleted", result, generation=generation)
+        return results
+
+    async def import_notes(self, notes):
+        # Validate in the pool so that the writer only runs statements
+        rows, tags = await self._run(Database._prepare_import, notes)
+        count, generation = await self._write(
+            lambda cur: Database._import_notes(cur, rows, tags),
+            method="import_notes",
+        )
+        # Too many changes to send one by one
+        self._publish("reset", {}, generation=generation)
+        return count
+
+    async def export_notes(self, *, batch_size=1000):
+        """Iterate over all notes by chunks of `batch_size`."""
+        after = 0
+        while True:
+            notes = await self._run(
+                self._db.export_notes, after=after, limit=batch_size
+            )
+            if not notes:
+                return
+
+            yield notes
+            after = notes[-1]["id"]
+
+    def close(self):
+        """Wait for pending queries and writes and close all connections."""
+        self._writes.put(None)
+        self._writer.join()
+        self._executor.shutdown(wait=True)
+        self._db.close()
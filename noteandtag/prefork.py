@@ -0,0 +1,104 @@
+"""Module for serving the application from several worker processes.
+
+The master process forks workers that each bind the same port with
+`SO_REUSEPORT`, so that the kernel balances incoming connections between
+them. Workers exiting unexpectedly are restarted until the master receives
+`SIGINT` or `SIGTERM`, which it forwards to them for a graceful shutdown.
+
+Metrics of all workers are shared through a temporary directory, see
+:func:`noteandtag.metrics.setup_worker`.
+"""
+__all__ = ["serve"]
+import logging
+import multiprocessing
+import shutil
+import signal
+import tempfile
+import time
+from multiprocessing.connection import wait
+from aiohttp import web
+from noteandtag import logqueue, metrics
+
+# Seconds to wait before restarting a worker that crashed right after start
+RESTART_DELAY = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+def _worker(app_factory, port, index, metrics_dir):
+    # Logs would be lost with the listener threads of master, and fork hooks
+    # restarting them need Python 3.7
+    logqueue.after_fork()
+
+    # Drop handlers inherited from master, run_app installs its own
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    try:
+        metrics.setup_worker(index, metrics_dir)
+        web.run_app(app_factory(index), port=port, reuse_port=True, print=None)
+    finally:
+        # Workers exit without running atexit handlers
+        logqueue.stop()
+
+
+def serve(app_factory, *, port: int, workers: int):
+    """Fork workers and supervise them until asked to stop.
+
+    The application is created by each worker after the fork, so that
+    nothing like DB connections or thread pools is shared between them.
+
+    :param app_factory: function creating the application, called with the
+        index of the worker, that a restarted worker takes over
+    :param port: port bound by all workers
+    :param workers: number of worker processes
+    """
+    context = multiprocessing.get_context("fork")
+    processes = {}
+    stopping = False
+    metrics_dir = tempfile.mkdtemp(prefix="noteandtag-metrics-")
+
+    def spawn(index):
+        process = context.Process(
+            target=_worker,
+            args=(app_factory, port, index, metrics_dir),
+            name=f"noteandtag-worker-{index}",
+        )
+        process.start()
+        processes[process.sentinel] = (index, process, time.monotonic())
+        logger.info("started worker %d with pid %d", index, process.pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for _, process, _ in processes.values():
+            process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    print(f"======== Running on http://0.0.0.0:{port} with {workers} workers ========")
+    for index in range(workers):
+        spawn(index)
+
+    try:
+        while processes:
+            for sentinel in wait(list(processes)):
+                index, process, started = processes.pop(sentinel)
+                process.join()
+                if stopping:
+                    continue
+
+                logger.error(
+                    "worker %d with pid %d exited with code %s, restarting",
+                    index,
+                    process.pid,
+                    process.exitcode,
+                )
+                # Avoid restarting in a loop when workers can't even start
+                if time.monotonic() - started < RESTART_DELAY:
+                    time.sleep(RESTART_DELAY)
+                if not stopping:
+                    spawn(index)
+    finally:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,141 @@
+"""Module for logging slow SQL statements along with their query plan.
+
+This is disabled until a threshold is set with :func:`setup`. Statements
+running longer are then logged to `noteandtag.slowquery` with their
+parameters, duration and `EXPLAIN QUERY PLAN` output:
+
+.. code-block:: text
+
+    slow query (0.153s): SELECT ... WHERE label LIKE ? ESCAPE '\\'
+    parameters: ('%milk%',)
+    plan:
+      SCAN note
+
+A fraction of slow statements can be sampled, and the number logged per
+minute is limited so that a burst of slow statements can't flood logs.
+"""
+__all__ = ["setup", "observe"]
+import logging
+import random
+import sqlite3
+import threading
+import time
+
+# Max number of slow statements logged per minute
+DEFAULT_RATE_LIMIT = 10
+# Max length of logged parameters
+MAX_PARAMETER_LENGTH = 100
+
+logger = logging.getLogger("noteandtag.slowquery")
+
+_threshold = None
+_sample_rate = 1.0
+_rate_limit = DEFAULT_RATE_LIMIT
+_lock = threading.Lock()
+_tokens = 0.0
+_last_refill = 0.0
+_skipped = 0
+
+
+def setup(
+    threshold: float = None,
+    *,
+    sample_rate: float = 1.0,
+    rate_limit: int = DEFAULT_RATE_LIMIT,
+) -> None:
+    """Enable or disable the slow-query log.
+
+    :param threshold: min duration in seconds of logged statements, `None` to disable
+    :param sample_rate: fraction of slow statements to log
+    :param rate_limit: max number of slow statements logged per minute
+    """
+    global _threshold, _sample_rate, _rate_limit, _tokens, _last_refill, _skipped
+
+    with _lock:
+        _threshold = threshold
+        _sample_rate = sample_rate
+        _rate_limit = rate_limit
+        _tokens = float(rate_limit)
+        _last_refill = time.monotonic()
+        _skipped = 0
+
+
+def _acquire():
+    """Take a token from the bucket allowing `rate_limit` logs per minute.
+
+    :return: if allowed, and the number of statements skipped before
+    """
+    global _tokens, _last_refill, _skipped
+
+    with _lock:
+        now = time.monotonic()
+        _tokens = min(_rate_limit, _tokens + (now - _last_refill) * _rate_limit / 60)
+        _last_refill = now
+        if _tokens < 1:
+            _skipped += 1
+            return False, 0
+
+        _tokens -= 1
+        skipped, _skipped = _skipped, 0
+        return True, skipped
+
+
+def _format_parameters(args) -> str:
+    return repr(
+        tuple(
+            _[:MAX_PARAMETER_LENGTH] + "..."
+            if isinstance(_, str) and len(_) > MAX_PARAMETER_LENGTH
+            else _
+            for _ in args
+        )
+    )
+
+
+def _explain(conn, stmt, args) -> str:
+    """Get the query plan of a statement as an indented tree."""
+    try:
+        rows = conn.execute("EXPLAIN QUERY PLAN " + stmt, args).fetchall()
+    except sqlite3.Error as e:
+        return f"  unavailable: {e}"
+
+    depths = {0: 0}
+    lines = []
+    for id, parent, _, detail in rows:
+        depths[id] = depths.get(parent, 0) + 1
+        lines.append("  " * depths[id] + detail)
+    return "\n".join(lines)
+
+
+def observe(conn, stmt: str, args, duration: float, *, many: bool = False) -> None:
+    """Log a statement if it is slow.
+
+    :param conn: connection that ran the statement
+    :param stmt: SQL statement
+    :param args: parameters of statement
+    :param duration: duration in seconds
+    :param many: if `args` is a list of parameters for each execution
+    """
+    if _threshold is None or duration < _threshold:
+        return
+    if _sample_rate < 1 and random.random() >= _sample_rate:
+        return
+
+    allowed, skipped = _acquire()
+    if not allowed:
+        return
+
+    if many:
+        # Explain the first execution only
+        args = args[0] if isinstance(args, (list, tuple)) and args else []
+    args = args or []
+
+    message = "slow query ({:.3f}s{}): {}\nparameters: {}\nplan:\n{}".format(
+        duration,
+        ", executemany" if many else "",
+        " ".join(stmt.split()),
+        _format_parameters(args),
+        _explain(conn, stmt, args),
+    )
+    if skipped:
+        message += f"\n{skipped} slow queries not logged before this one"
+    logger.warning(message)
@@ -43,6 +43,7 @@ setup(
         "aiohttp-jinja2",
         "pyyaml",
     ],
+    extras_require={"fast": ["orjson"], "brotli": ["brotli"]},
     test_suite="test",
     tests_require=["nose", "nose-cover3"],
     include_package_data=True,
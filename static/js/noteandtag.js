@@ -15,6 +15,7 @@ $(document).ready(function() {
 		this._root.html("");
 		this._api_base_url = api_base_url
 		this._selection_changed = $.Callbacks();
+		this._refresh_timer = null;
 	};
 	
 	TagsUI.prototype = {
@@ -25,11 +26,17 @@ $(document).ready(function() {
 		_on_tag_clicked: function(name)
 		{
 			this._root.find(`.nat-tag[data-name='${name}']`).toggleClass("nat-tag-selected");
+			this._selection_changed.fire(this.selection());
+		},
+		selection: function()
+		{
 			let tags = $.makeArray(this._root.find(".nat-tag-selected .nat-tag-name"));
-			this._selection_changed.fire(tags.map(o => $(o).text()));
+			return tags.map(o => $(o).text());
 		},
 		_display: function(tags)
 		{
+			// keep selected tags selected
+			let selection = this.selection();
 			this._root.html("");
 			tags.forEach(tag => {
 				let element = $("<a>", {'class': 'nat-tag', 'href': '#', 'data-name': tag["name"]}).append(
@@ -37,9 +44,20 @@ $(document).ready(function() {
 					$("<span>", {'class': 'nat-tag-total', 'text': tag["total"]}),
 				);
 				element.click(() => this._on_tag_clicked(tag["name"]));
+				if (selection.includes(tag["name"]))
+				{
+					element.addClass("nat-tag-selected");
+				}
 				this._root.append(element);
 			});
 		},
+		/**
+		* Query tags once after a burst of changes.
+		*/
+		refresh: function() {
+			clearTimeout(this._refresh_timer);
+			this._refresh_timer = setTimeout(() => this.query(), 500);
+		},
 		query: function() {
 			$.ajax({
 				url: this._api_base_url + "tags",
@@ -89,6 +107,12 @@ $(document).ready(function() {
 		this._widgets.form.newtag.change(() => this._check_newtag());
 		this._widgets.form.newtag.keyup(() => this._check_newtag());
 		this._widgets.form.newtag.keydown(() => this._check_newtag());
+		this._widgets.form.newtag.autocomplete({
+			minLength: 1,
+			delay: 100,
+			source: (request, response) => this._complete_newtag(request.term, response),
+			select: (event, ui) => this._on_completion_selected(ui.item.value)
+		});
 		this._widgets.form.body.change(() => this._resize_textarea());
 		this._widgets.form.body.keyup(() => this._resize_textarea());
 		this._widgets.form.body.keydown(() => this._resize_textarea());
@@ -166,6 +190,36 @@ $(document).ready(function() {
 			this._widgets.form.newtag.val("");
 		},
 		/**
+		* Suggest most used tags starting with user input.
+		* @param  {String} term User input
+		* @param  {Function} response Called with suggestions
+		*/
+		_complete_newtag: function(term, response) {
+			$.ajax({
+				url: api_base_url + "tags",
+				type: "GET",
+				dataType: "json",
+				data: {"prefix": term, "limit": 10},
+				success: (tags) => {
+					response(tags.filter(tag => !this._tags.includes(tag["name"])).map(tag => ({
+						label: `${tag["name"]} (${tag["total"]})`,
+						value: tag["name"]
+					})));
+				},
+				error: () => response([])
+			});
+		},
+		/**
+		* Called when user picked a suggested tag.
+		* @param  {String} tag Tag text
+		*/
+		_on_completion_selected: function(tag) {
+			this._add_tag(tag);
+			this._widgets.form.newtag.val("");
+			// keep input empty instead of filling it with the tag
+			return false;
+		},
+		/**
 		* Add a new tag to the list and UI.
 		* @param  {String} tag Tag text
 		*/
@@ -301,6 +355,7 @@ $(document).ready(function() {
 		this._widgets.editor.saved((data) => this._on_note_added(data));
 		this._root.append(this._widgets.editor.root);
 		this._api_base_url = api_base_url
+		this._query_tags = undefined;
 	};
 	
 	NotesUI.prototype = {
@@ -310,7 +365,37 @@ $(document).ready(function() {
 				note.root.remove();
 			});
 			this._widgets.notes = []
-			notes.forEach(data => this._on_note_added(data));
+			notes.forEach(data => this._add(data));
+		},
+		_find: function(id) {
+			return this._widgets.notes.find(note => note.data["id"] == id);
+		},
+		/**
+		* Check if a note matches the tags currently queried.
+		* @param  {Object} data Note data
+		*/
+		_matches: function(data) {
+			if (this._query_tags === undefined)
+			{
+				return true;
+			}
+			return this._query_tags.every(tag => data["tags"].includes(tag));
+		},
+		_add: function(data) {
+			// may already be added by a change event
+			if (this._find(data["id"]) !== undefined)
+			{
+				return;
+			}
+
+			let widget = new NoteUI(data);
+			widget.edit(() => this._on_edit(widget));
+			this._widgets.notes.push(widget);
+			widget.root.insertAfter(this._widgets.editor.root);
+		},
+		_remove: function(note) {
+			note.root.remove();
+			this._widgets.notes.splice(this._widgets.notes.indexOf(note), 1);
 		},
 		_on_edit: function(note) {
 			let editor = new NoteEditor(note.data);
@@ -330,20 +415,41 @@ $(document).ready(function() {
 			this._changed.fire();
 		},
 		_on_note_added: function(data) {
-			let widget = new NoteUI(data);
-			widget.edit(() => this._on_edit(widget));
-			this._widgets.notes.push(widget);
-			widget.root.insertAfter(this._widgets.editor.root);
+			this._add(data);
 			this._changed.fire();
 		},
+		/**
+		* Patch displayed notes with a change pushed by server.
+		* @param  {String} type Type of change
+		* @param  {Object} data Note data, or only its id when deleted
+		*/
+		apply: function(type, data) {
+			let note = this._find(data["id"]);
+			if (type == "note-deleted" || !this._matches(data))
+			{
+				if (note !== undefined)
+				{
+					this._remove(note);
+				}
+			}
+			else if (note !== undefined)
+			{
+				note.update(data);
+			}
+			else
+			{
+				this._add(data);
+			}
+		},
 		changed: function(cb) {
 			this._changed.add(cb);
 		},
 		query: function(tags) {
 			data = {}
-			if (tags !== undefined) {
+			if (tags !== undefined && tags.length > 0) {
 				data["tags"] = tags.join(",");
 			}
+			this._query_tags = data["tags"] !== undefined ? tags : undefined;
 
 			$.ajax({
 				url: this._api_base_url + "notes/",
@@ -361,8 +467,24 @@ $(document).ready(function() {
 	let notes = new NotesUI($("#nat-notes"), api_base_url);
 	let tags = new TagsUI($("#nat-tags"), api_base_url);
 
-	notes.changed(() => tags.query());
+	notes.changed(() => tags.refresh());
 	tags.selection_changed((tags) => notes.query(tags));
 	tags.query();
 	notes.query();
+
+	// patch views with changes made elsewhere instead of polling
+	if (window.EventSource !== undefined) {
+		let events = new EventSource(api_base_url + "events");
+		["note-created", "note-updated", "note-deleted"].forEach(type => {
+			events.addEventListener(type, (e) => {
+				notes.apply(type, JSON.parse(e.data));
+				tags.refresh();
+			});
+		});
+		// changes were missed, fetch everything again
+		events.addEventListener("reset", () => {
+			tags.query();
+			notes.query(tags.selection());
+		});
+	}
 });
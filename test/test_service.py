@@ -1,11 +1,35 @@
 # -*- coding: utf-8 -*-
 __all__ = ["ServiceTestCase"]
+import asyncio
 import os
 import unittest
 import json
+import logging
 import sqlite3
-from aiohttp.test_utils import AioHTTPTestCase, unittest_run_loop
-from noteandtag import configuration, Application
+import tempfile
+import threading
+from unittest import mock
+import aiohttp_jinja2
+from aiohttp import web
+from aiohttp.test_utils import (
+    AioHTTPTestCase,
+    TestClient,
+    TestServer,
+    unittest_run_loop,
+)
+from noteandtag import (
+    configuration,
+    feed,
+    logqueue,
+    metrics,
+    monad,
+    prefork,
+    slowlog,
+    Application,
+)
+from noteandtag.app import assets, encoder, validator
+from noteandtag.feed import ChangeFeed
+from noteandtag.migrations import MIGRATIONS
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 CONFIG_CNF = os.path.join(DATA_DIR, "config.cnf")
@@ -34,6 +58,7 @@ class ServiceTestCase(AioHTTPTestCase):
             swagger_url=config["service"].get("swagger-url", None),
             api_base_url=config["service"]["api-base-url"],
             base_url=config["service"]["base-url"],
+            metrics_url=config["service"].get("metrics-url", None),
         )
 
     @unittest_run_loop
@@ -106,6 +131,942 @@ class ServiceTestCase(AioHTTPTestCase):
         notes = await self._get_notes(params={"tags": "a"})
         assert len(notes) == 1
 
+    @unittest_run_loop
+    async def test_update_tags(self):
+        self._clean_db()
+
+        new_note = await self._add_note(
+            note(label="test", author="test", body="test", tags=["a", "b", "b"])
+        )
+        assert new_note["tags"] == ["a", "b"]
+
+        # Only changed tags are written
+        new_note["tags"] = ["b", "c"]
+        await self._update_note(new_note)
+        fetched_note = await self._get_note(new_note["id"])
+        assert sorted(fetched_note["tags"]) == ["b", "c"]
+
+        # Tag counts follow
+        tags = await self._get_tags()
+        assert {_["name"]: _["total"] for _ in tags} == {"b": 1, "c": 1}
+
+        # Invalid notes are rejected
+        new_note["label"] = "test2"
+        new_note["tags"] = [["invalid"]]
+        await self._update_note(new_note, status=400)
+        await self._add_note(note(label="test", tags="a"), status=400)
+        resp = await self.client.put("/api/v1/notes", data="not json")
+        assert resp.status == 400
+        resp = await self.client.post(f"/api/v1/notes/{new_note['id']}", data="{")
+        assert resp.status == 400
+
+        # A failed write leaves DB untouched
+        execute_many = monad._CursorContext.execute_many
+
+        def failing_execute_many(cur, stmt, args):
+            if stmt.startswith("INSERT INTO note_tag"):
+                raise sqlite3.OperationalError("injected failure")
+            return execute_many(cur, stmt, args)
+
+        new_note["tags"] = ["d"]
+        with mock.patch.object(
+            monad._CursorContext, "execute_many", failing_execute_many
+        ):
+            await self._update_note(new_note, status=500)
+            await self._add_note(note(label="test3", tags=["e"]), status=500)
+
+        fetched_note = await self._get_note(new_note["id"])
+        assert fetched_note["label"] == "test"
+        assert sorted(fetched_note["tags"]) == ["b", "c"]
+        assert [_["id"] for _ in await self._get_notes()] == [new_note["id"]]
+        tags = await self._get_tags()
+        assert {_["name"]: _["total"] for _ in tags} == {"b": 1, "c": 1}
+
+    @unittest_run_loop
+    async def test_tag_prefix(self):
+        self._clean_db()
+
+        for tags in (["python", "pytest"], ["python", "pyramid"], ["python", "perl"]):
+            await self._add_note(note(label="test", tags=tags))
+
+        # Most used tags first
+        resp = await self.client.get("/api/v1/tags", params={"prefix": "py"})
+        assert resp.headers["X-Total-Count"] == "3"
+        tags = json.loads(await resp.read())
+        assert [_["name"] for _ in tags] == ["python", "pytest", "pyramid"]
+        assert tags[0]["total"] == 3
+
+        # Pages of matching tags
+        resp = await self.client.get(
+            "/api/v1/tags", params={"prefix": "py", "limit": 2}
+        )
+        resp = await self.client.get(resp.links["next"]["url"].path_qs)
+        assert [_["name"] for _ in json.loads(await resp.read())] == ["pyramid"]
+
+        resp = await self.client.get("/api/v1/tags", params={"prefix": "pyz"})
+        assert json.loads(await resp.read()) == []
+
+    @unittest_run_loop
+    async def test_search(self):
+        self._clean_db()
+
+        await self._add_note(
+            note(label="groceries", author="test", body="milk milk eggs", tags=[])
+        )
+        await self._add_note(
+            note(label="Shopping list", author="test", body="milk bread", tags=[])
+        )
+
+        # Full-text search is case insensitive and matches substrings
+        notes = await self._get_notes(params={"label": "SHOP"})
+        assert [_["label"] for _ in notes] == ["Shopping list"]
+
+        # Short terms fallback to a scan
+        notes = await self._get_notes(params={"label": "ro"})
+        assert [_["label"] for _ in notes] == ["groceries"]
+
+        # Best matches first
+        notes = await self._get_notes(params={"body": "milk", "sortBy": "rank"})
+        assert [_["label"] for _ in notes] == ["groceries", "Shopping list"]
+
+    def test_search_without_fts(self):
+        execute = monad._CursorContext.execute
+
+        # SQLite older than 3.34 has no trigram tokenizer
+        def failing_execute(cur, stmt, args=None):
+            if "USING fts5" in stmt:
+                raise sqlite3.OperationalError("no such tokenizer: trigram")
+            return execute(cur, stmt, args)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.object(monad._CursorContext, "execute", failing_execute):
+                db = monad.Database(os.path.join(tmp, "db.sqlite3"))
+            try:
+                assert db.migrate() == len(MIGRATIONS)
+                first = db.add_note(note(label="groceries", body="milk eggs"))
+                db.add_note(note(label="Shopping list", body="milk bread"))
+                db.update_note(first["id"], dict(first, body="eggs"))
+
+                notes = db.get_notes(filters={}, label="shop")[0]
+                assert [_["label"] for _ in notes] == ["Shopping list"]
+                notes = db.get_notes(filters={}, body="milk")[0]
+                assert [_["label"] for _ in notes] == ["Shopping list"]
+            finally:
+                db.close()
+
+    @unittest_run_loop
+    async def test_tags_filter(self):
+        self._clean_db()
+
+        for i in range(5):
+            await self._add_note(
+                note(label="test", author="test", body="test", tags=["a", "b"])
+            )
+            await self._add_note(
+                note(label="test", author="test", body="test", tags=["a"])
+            )
+
+        # Pages are full and total is exact
+        resp = await self.client.get(
+            "/api/v1/notes", params={"tags": "a,b", "offset": 2, "limit": 2}
+        )
+        assert resp.status == 200
+        assert resp.headers["X-Total-Count"] == "5"
+        notes = json.loads(await resp.read())
+        assert len(notes) == 2
+        for _ in notes:
+            assert sorted(_["tags"]) == ["a", "b"]
+
+        # Duplicated tags are ignored
+        resp = await self.client.get("/api/v1/notes", params={"tags": "a,a"})
+        assert resp.headers["X-Total-Count"] == "10"
+
+    @unittest_run_loop
+    async def test_batch(self):
+        self._clean_db()
+
+        a = await self._add_note(note(label="a", tags=["x"]))
+        b = await self._add_note(note(label="b"))
+
+        # Failing operations are skipped, later ones see earlier changes
+        resp = await self.client.post(
+            "/api/v1/batch",
+            data=json.dumps(
+                {
+                    "operations": [
+                        {"op": "update", "id": a["id"], "data": note(label="a2")},
+                        {"op": "get", "id": a["id"]},
+                        {"op": "create", "data": {"label": "invalid"}},
+                        {"op": "create", "id": b["id"], "data": note(label="c")},
+                        {"op": "delete", "id": b["id"]},
+                        {"op": "delete", "id": b["id"]},
+                    ]
+                }
+            ),
+        )
+        assert resp.status == 200
+        results = json.loads(await resp.read())["results"]
+        assert [_["status"] for _ in results] == [200, 200, 400, 409, 200, 404]
+        assert results[1]["data"]["label"] == "a2"
+        assert await self._get_note(b["id"], status=404) is None
+
+        # Atomic batches are all or nothing
+        resp = await self.client.post(
+            "/api/v1/batch",
+            data=json.dumps(
+                {
+                    "operations": [
+                        {"op": "update", "id": a["id"], "data": note(label="a3")},
+                        {"op": "update", "id": b["id"], "data": note(label="b3")},
+                    ],
+                    "atomic": True,
+                }
+            ),
+        )
+        assert resp.status == 400
+        assert "operation 1" in json.loads(await resp.read())["error_description"]
+        assert (await self._get_note(a["id"]))["label"] == "a2"
+
+        resp = await self.client.post("/api/v1/batch", data="[]")
+        assert resp.status == 400
+
+    @unittest_run_loop
+    async def test_sync(self):
+        self._clean_db()
+
+        a = await self._add_note(note(label="a"))
+        b = await self._add_note(note(label="b"))
+        conn = sqlite3.connect(self.db_path)
+        since = conn.execute("SELECT seq FROM note WHERE id=?", (b["id"],)).fetchone()[
+            0
+        ]
+
+        # Changes from any code path are tracked
+        a["label"] = "a2"
+        await self._update_note(a)
+        c = await self._add_note(note(label="c", tags=["t"]))
+        conn.execute("DELETE FROM note WHERE id=?", (b["id"],))
+        conn.commit()
+        conn.close()
+
+        resp = await self.client.get(
+            "/api/v1/notes", params={"since": since, "limit": 2}
+        )
+        assert resp.status == 200
+        assert resp.headers["X-Total-Count"] == "3"
+        changes = json.loads(await resp.read())
+        assert [(_["id"], _["label"]) for _ in changes] == [
+            (a["id"], "a2"),
+            (c["id"], "c"),
+        ]
+        assert changes[1]["tags"] == ["t"]
+        assert changes[0]["seq"] < changes[1]["seq"]
+
+        resp = await self.client.get(resp.links["next"]["url"].path_qs)
+        changes = json.loads(await resp.read())
+        assert [(_["id"], _["deleted"]) for _ in changes] == [(b["id"], True)]
+
+        resp = await self.client.get(
+            "/api/v1/notes", params={"since": changes[0]["seq"]}
+        )
+        assert json.loads(await resp.read()) == []
+
+        resp = await self.client.get("/api/v1/notes", params={"since": "invalid"})
+        assert resp.status == 400
+
+    @unittest_run_loop
+    async def test_migrate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Database created before versions and change tracking existed
+            db_path = os.path.join(tmp, "db.sqlite3")
+            conn = sqlite3.connect(db_path)
+            conn.execute(
+                "CREATE TABLE note (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " label TEXT NOT NULL, author TEXT NOT NULL, body TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE note_tag (noteid INTEGER NOT NULL,"
+                " label TEXT NOT NULL, PRIMARY KEY(noteid, label))"
+            )
+            conn.executemany(
+                "INSERT INTO note (label, author, body) VALUES (?, 'a', ?)",
+                [(f"n{i}", f"body{i}") for i in range(5)],
+            )
+            conn.executemany(
+                "INSERT INTO note_tag VALUES (?, ?)",
+                [(1, "t"), (1, "u"), (2, "t"), (3, "v"), (4, "u")],
+            )
+            conn.commit()
+            conn.close()
+
+            db = monad.Database(db_path, migrate=False)
+            try:
+                # Interrupt the tag backfill after its first batch
+                with db._transaction() as cur:
+                    MIGRATIONS[0].schema(cur)
+                    MIGRATIONS[1].schema(cur)
+                    assert MIGRATIONS[1].backfill(cur, 1)
+                    assert (
+                        cur.query_value(
+                            "SELECT after FROM migration_progress WHERE name = 'tag'"
+                        )
+                        == 1
+                    )
+
+                # Tags written meanwhile are counted once, before and after
+                with db._transaction() as cur:
+                    cur.execute("DELETE FROM note_tag WHERE noteid = 1 AND label = 't'")
+                    cur.execute("DELETE FROM note_tag WHERE noteid = 3")
+                    cur.execute("INSERT INTO note_tag VALUES (5, 't')")
+
+                assert db.migrate(online=True, batch_size=2) == len(MIGRATIONS)
+                assert db.migrate() == len(MIGRATIONS)
+                with db._cursor() as cur:
+                    assert cur.query_value("PRAGMA user_version") == len(MIGRATIONS)
+                    assert [_["seq"] for _ in cur.query("SELECT seq FROM note")] == [
+                        1,
+                        2,
+                        3,
+                        4,
+                        5,
+                    ]
+                    assert not cur.query("SELECT * FROM migration_progress")
+                assert {_["name"]: _["total"] for _ in db.get_tags(filters={})[0]} == {
+                    "t": 2,
+                    "u": 2,
+                }
+                assert [
+                    _["label"] for _ in db.get_notes(filters={}, body="body3")[0]
+                ] == ["n3"]
+
+                new_note = db.add_note(note(label="n5"))
+                assert db.get_changes(filters={}, since=5)[0][0]["id"] == new_note["id"]
+                assert (
+                    db.get_notes(filters={}, label="n5")[0][0]["id"] == new_note["id"]
+                )
+            finally:
+                db.close()
+
+            # Versions from the future are refused
+            conn = sqlite3.connect(db_path)
+            conn.execute(f"PRAGMA user_version = {len(MIGRATIONS) + 1}")
+            conn.close()
+            with self.assertRaises(RuntimeError):
+                monad.Database(db_path)
+
+    @unittest_run_loop
+    async def test_cursor(self):
+        self._clean_db()
+
+        ids = []
+        for i in range(7):
+            new_note = await self._add_note(
+                note(label="test", author="test", body="test", tags=[f"t{i}"])
+            )
+            ids.append(new_note["id"])
+
+        # Walk all notes and tags by following Link headers
+        for url, key in (("/api/v1/notes", "id"), ("/api/v1/tags", "name")):
+            items = []
+            next_url = f"{url}?limit=3"
+            while next_url:
+                resp = await self.client.get(next_url)
+                assert resp.status == 200
+                assert resp.headers["X-Total-Count"] == "7"
+                items.extend(_[key] for _ in json.loads(await resp.read()))
+                next_link = resp.links.get("next")
+                next_url = next_link["url"].path_qs if next_link else None
+            assert len(items) == 7
+            assert items == sorted(items)
+
+        # Invalid cursor
+        resp = await self.client.get("/api/v1/notes", params={"after": "invalid"})
+        assert resp.status == 400
+        for url, key in (
+            ("/api/v1/notes", [{}]),
+            ("/api/v1/notes", ["1"]),
+            ("/api/v1/notes", [True]),
+            ("/api/v1/tags", [1]),
+            ("/api/v1/tags", [None]),
+        ):
+            resp = await self.client.get(
+                url, params={"after": validator._encode_cursor(key)}
+            )
+            assert resp.status == 400
+
+        # Limit is no longer silently capped
+        resp = await self.client.get("/api/v1/notes", params={"limit": 1000})
+        assert resp.status == 400
+
+    @unittest_run_loop
+    async def test_sort(self):
+        self._clean_db()
+
+        for label, author, tags in (
+            ("b", "x", ["t1"]),
+            ("a", "y", ["t1", "t2"]),
+            ("c", "y", ["t1", "t2", "t3"]),
+            ("a", "x", []),
+        ):
+            await self._add_note(note(label=label, author=author, tags=tags))
+
+        # Follow Link headers with mixed sort orders
+        async def walk(url, params):
+            items = []
+            while url:
+                resp = await self.client.get(url, params=params)
+                assert resp.status == 200
+                items.extend(json.loads(await resp.read()))
+                next_link = resp.links.get("next")
+                url = next_link["url"].path_qs if next_link else None
+                params = None
+            return items
+
+        notes = await walk("/api/v1/notes", {"sortBy": "author:desc,label", "limit": 1})
+        assert [(_["author"], _["label"]) for _ in notes] == [
+            ("y", "a"),
+            ("y", "c"),
+            ("x", "a"),
+            ("x", "b"),
+        ]
+
+        notes = await walk("/api/v1/notes", {"sortBy": "label:desc", "limit": 2})
+        assert [_["label"] for _ in notes] == ["c", "b", "a", "a"]
+
+        tags = await walk("/api/v1/tags", {"sortBy": "total:desc", "limit": 2})
+        assert [_["name"] for _ in tags] == ["t1", "t2", "t3"]
+
+        # Only whitelisted fields
+        for url, sort in (
+            ("/api/v1/notes", "body"),
+            ("/api/v1/notes", "rank"),
+            ("/api/v1/tags", "label"),
+            ("/api/v1/tags", "name,name"),
+        ):
+            resp = await self.client.get(url, params={"sortBy": sort})
+            assert resp.status == 400
+
+    @unittest_run_loop
+    async def test_etag(self):
+        self._clean_db()
+
+        new_note = await self._add_note(note(label="test", tags=["a"]))
+
+        for url in ("/api/v1/notes", "/api/v1/tags", f"/api/v1/notes/{new_note['id']}"):
+            resp = await self.client.get(url)
+            assert resp.status == 200
+            etag = resp.headers["ETag"]
+
+            # Nothing changed
+            resp = await self.client.get(url, headers={"If-None-Match": etag})
+            assert resp.status == 304
+            assert resp.headers["ETag"] == etag
+
+            # Any write changes the ETag
+            await self._update_note(new_note)
+            resp = await self.client.get(url, headers={"If-None-Match": etag})
+            assert resp.status == 200
+            assert resp.headers["ETag"] != etag
+
+            # Even from another process, such as the import command
+            etag = resp.headers["ETag"]
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("UPDATE note SET body = body || '.'")
+            conn.commit()
+            conn.close()
+            resp = await self.client.get(url, headers={"If-None-Match": etag})
+            assert resp.status == 200
+
+        # Reading the sequence never blocks the event loop
+        threads = []
+        etag = monad.Database.etag
+
+        def recording_etag(db):
+            threads.append(threading.current_thread())
+            return etag.fget(db)
+
+        with mock.patch.object(monad.Database, "etag", property(recording_etag)):
+            resp = await self.client.get("/api/v1/notes")
+            assert resp.status == 200
+        assert threads and threading.main_thread() not in threads
+
+    def test_shared_generation(self):
+        import multiprocessing
+
+        generation = monad.Generation(shared=True, workers=2)
+        db = monad.Database(self.db_path, generation=generation.worker(0))
+        etag = db.etag
+
+        # A write from another worker process changes the ETag
+        def add_note():
+            worker_db = monad.Database(self.db_path, generation=generation.worker(1))
+            worker_db.add_note(note(id=None, label="worker"))
+            worker_db.close()
+
+        process = multiprocessing.get_context("fork").Process(target=add_note)
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+        assert db.etag != etag
+
+        # Each worker counts its writes in its own slot, without locking
+        assert generation.value == 1
+        db.add_note(note(id=None, label="master"))
+        assert generation.value == 2
+        assert list(generation._slots) == [1, 1]
+        db.close()
+
+    def test_prefork(self):
+        import multiprocessing
+        import signal
+        import socket
+        import time
+
+        with socket.socket() as s:
+            s.bind(("", 0))
+            port = s.getsockname()[1]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Each worker records its pid when creating the application
+            def create_app(index):
+                open(os.path.join(tmp, str(os.getpid())), "w").close()
+                return web.Application()
+
+            def wait_workers(count):
+                for _ in range(100):
+                    pids = set(int(_) for _ in os.listdir(tmp))
+                    if len(pids) >= count:
+                        return pids
+                    time.sleep(0.1)
+                raise AssertionError(f"{count} workers not started")
+
+            master = multiprocessing.get_context("fork").Process(
+                target=prefork.serve,
+                args=(create_app,),
+                kwargs={"port": port, "workers": 2},
+            )
+            master.start()
+            try:
+                # A killed worker is restarted
+                pids = wait_workers(2)
+                os.kill(pids.pop(), signal.SIGKILL)
+                pids = wait_workers(3)
+            finally:
+                master.terminate()
+                master.join(10)
+
+            # Workers are stopped along with master
+            assert master.exitcode == 0
+            for pid in pids:
+                with self.assertRaises(ProcessLookupError):
+                    os.kill(pid, 0)
+
+    @unittest_run_loop
+    async def test_group_commit(self):
+        self._clean_db()
+
+        db = monad.AsyncDatabase(self.db_path, commit_interval=0.1)
+        existing = await db.add_note(note(id=None, label="existing"))
+
+        with mock.patch.object(
+            db._db, "write_many", wraps=db._db.write_many
+        ) as write_many:
+            results = await asyncio.gather(
+                *[db.add_note(note(id=None, label=f"n{i}")) for i in range(50)],
+                db.add_note(note(label="duplicate"), id=existing["id"]),
+                db.import_notes([note(id=None, label="imported")]),
+                return_exceptions=True,
+            )
+
+        # All writes are committed together, except the failing one
+        assert write_many.call_count == 1
+        assert isinstance(results[-2], sqlite3.IntegrityError)
+        assert len(set(_["id"] for _ in results[:-2])) == 50
+        assert results[-1] == 1
+        assert (await db.get_note_by_id(existing["id"]))["label"] == "existing"
+        _, total, _ = await db.get_notes()
+        assert total == 52
+        db.close()
+
+    @unittest_run_loop
+    async def test_stream(self):
+        self._clean_db()
+
+        lines = [
+            json.dumps(note(id=None, label=f"n{i}", tags=[f"t{i}"]))
+            for i in range(1200)
+        ]
+        resp = await self.client.post("/api/v1/notes/import", data="\n".join(lines))
+        assert resp.status == 200
+
+        # Pages larger than the default limit
+        for url in ("/api/v1/notes", "/api/v1/tags"):
+            resp = await self.client.get(url, params={"stream": "true", "limit": 1100})
+            assert resp.status == 200
+            assert resp.headers["X-Total-Count"] == "1200"
+            assert "ETag" in resp.headers
+            assert len(json.loads(await resp.read())) == 1100
+
+        notes = await self._get_notes(params={"stream": "1", "tags": "t3"})
+        assert [_["tags"] for _ in notes] == [["t3"]]
+
+        # Empty result
+        notes = await self._get_notes(params={"stream": "1", "tags": "none"})
+        assert notes == []
+
+        resp = await self.client.get(
+            "/api/v1/notes", params={"stream": "true", "limit": 100000}
+        )
+        assert resp.status == 400
+
+        # A stalled client releases its thread of the pool
+        db = monad.AsyncDatabase(self.db_path, workers=1)
+        try:
+            with mock.patch.object(monad, "STREAM_TIMEOUT", 0.1):
+                chunks, _, __ = await db.get_notes(
+                    filters={"stream": True, "limit": 1100}
+                )
+                await chunks.__anext__()
+                await asyncio.sleep(0.5)
+                with self.assertRaises(TimeoutError):
+                    async for _ in chunks:
+                        pass
+                assert len((await db.get_tags(filters={}))[0]) == 50
+        finally:
+            db.close()
+
+    def test_encoder(self):
+        data = [note(id=1, label="é", tags=["a"])]
+        try:
+            for name in encoder.BACKENDS:
+                encoder.setup(name)
+                assert encoder.backend() == name
+                assert json.loads(encoder.dumps(data)) == data
+        finally:
+            encoder.setup("auto")
+
+        with self.assertRaises(ValueError):
+            encoder.setup("unknown")
+
+    @unittest_run_loop
+    async def test_index(self):
+        with mock.patch(
+            "aiohttp_jinja2.render_string", wraps=aiohttp_jinja2.render_string
+        ) as render_string:
+            resp = await self.client.get("/")
+            assert resp.status == 200
+            etag = resp.headers["ETag"]
+            assert "theme-monokaiorange.css" in await resp.text()
+
+            # Rendered once per theme
+            resp = await self.client.get("/", headers={"If-None-Match": etag})
+            assert resp.status == 304
+            resp = await self.client.get("/", params={"theme": "porteraqua"})
+            assert "theme-porteraqua.css" in await resp.text()
+            assert resp.headers["ETag"] != etag
+            assert render_string.call_count == 2
+
+            # Unknown themes fallback to default one
+            resp = await self.client.get("/", params={"theme": "../unknown"})
+            assert resp.headers["ETag"] == etag
+            assert render_string.call_count == 2
+
+    @unittest_run_loop
+    async def test_metrics(self):
+        self._clean_db()
+
+        new_note = await self._add_note(note(label="test", tags=["a"]))
+        await self._get_note(new_note["id"])
+        await self._get_notes()
+
+        resp = await self.client.get("/metrics")
+        assert resp.status == 200
+        text = await resp.text()
+        for line in (
+            'noteandtag_http_requests_total{route="/api/v1/notes",method="GET",status="200"}',
+            'noteandtag_http_request_duration_seconds_count{route="/api/v1/notes/{id}",method="GET"}',
+            'noteandtag_db_call_duration_seconds_count{method="get_notes"}',
+            'noteandtag_db_query_duration_seconds_count{method="write_many"}',
+            'noteandtag_db_write_duration_seconds_count{method="add_note"}',
+            'noteandtag_db_pending{queue="pool"} 0.0',
+        ):
+            assert line in text, line
+
+        # Workers render the samples of each other
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch.object(metrics, "_worker", 1), mock.patch.object(
+                metrics, "_directory", tmp
+            ):
+                with open(os.path.join(tmp, "worker-0.json"), "w") as f:
+                    json.dump(
+                        {
+                            "noteandtag_db_pending": [
+                                'noteandtag_db_pending{queue="pool",worker="0"} 2.0'
+                            ]
+                        },
+                        f,
+                    )
+                text = metrics.render().decode("utf-8")
+
+        assert 'noteandtag_db_pending{queue="pool",worker="0"} 2.0' in text
+        assert 'noteandtag_db_pending{queue="pool",worker="1"} 0.0' in text
+        assert text.count("# TYPE noteandtag_db_pending gauge") == 1
+
+    @unittest_run_loop
+    async def test_slow_query_log(self):
+        self._clean_db()
+        await self._add_note(note(label="groceries", body="milk"))
+
+        try:
+            # Log every statement, at most 2 per minute
+            slowlog.setup(0, rate_limit=2)
+            with self.assertLogs("noteandtag.slowquery") as logs:
+                await self._get_notes(params={"label": "ro"})
+                await self._get_notes(params={"label": "ro"})
+        finally:
+            slowlog.setup(None)
+
+        # The ETag is read first, then notes are counted
+        assert len(logs.output) == 2
+        assert "parameters: ('%ro%'" in logs.output[1]
+        assert "plan:\n" in logs.output[1]
+
+    @unittest_run_loop
+    async def test_log_queue(self):
+        class Handler(logging.Handler):
+            def __init__(self):
+                super().__init__()
+                self.released = threading.Event()
+                self.records = []
+
+            def emit(self, record):
+                self.released.wait()
+                self.records.append((record.getMessage(), threading.current_thread()))
+
+        logger = logging.getLogger("noteandtag.test.logqueue")
+        logger.propagate = False
+        handler = Handler()
+        dropped = metrics.LOG_DROPPED.labels(logger=logger.name)
+        logqueue.attach(logger, [handler], queue_size=2)
+        try:
+            # Handler is stuck, so records are dropped instead of blocking
+            for i in range(10):
+                logger.warning("record %d", i)
+            assert dropped._value >= 7
+
+            handler.released.set()
+        finally:
+            logqueue.stop()
+            logger.handlers = []
+
+        assert 1 <= len(handler.records) <= 3
+        assert handler.records[0][0] == "record 0"
+        assert handler.records[0][1] is not threading.current_thread()
+
+        # Forked workers restart listeners, even without fork hooks
+        import multiprocessing
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "worker.log")
+            logqueue.attach(logger, [logging.FileHandler(path)])
+
+            def worker():
+                logqueue._pid = os.getppid()
+                logqueue.after_fork()
+                logqueue.after_fork()
+                assert len(logqueue._listeners) == len(logqueue._queues)
+                logger.warning("from worker")
+                logqueue.stop()
+
+            try:
+                process = multiprocessing.get_context("fork").Process(target=worker)
+                process.start()
+                process.join()
+                assert process.exitcode == 0
+                with open(path) as f:
+                    assert f.read() == "from worker\n"
+            finally:
+                logqueue.stop()
+                logger.handlers = []
+
+        # Errors are always kept when sampling access logs
+        sampling = logqueue.SamplingFilter(0)
+        access = dict(name="aiohttp.access", level=logging.INFO, pathname="", lineno=0)
+        assert not sampling.filter(
+            logging.makeLogRecord(dict(access, response_status=200))
+        )
+        assert sampling.filter(logging.makeLogRecord(dict(access, response_status=500)))
+
+    @unittest_run_loop
+    async def test_events(self):
+        self._clean_db()
+
+        async def read_event(resp):
+            event = {}
+            while True:
+                line = (await resp.content.readline()).decode("utf-8").rstrip("\n")
+                if not line:
+                    if "event" in event:
+                        return event
+                    continue
+                field, _, value = line.partition(": ")
+                event[field] = value
+
+        # Changes are pushed as they are committed
+        resp = await self.client.get("/api/v1/events")
+        assert resp.headers["Content-Type"] == "text/event-stream"
+        new_note = await self._add_note(note(label="test", tags=["a"]))
+        event = await read_event(resp)
+        assert event["event"] == "note-created"
+        assert json.loads(event["data"]) == new_note
+        resp.close()
+
+        # Changes missed while disconnected are sent on reconnection
+        new_note["label"] = "test2"
+        await self._update_note(new_note)
+        resp = await self.client.get(
+            "/api/v1/events", headers={"Last-Event-ID": event["id"]}
+        )
+        event = await read_event(resp)
+        assert event["event"] == "note-updated"
+        assert json.loads(event["data"])["label"] == "test2"
+        resp.close()
+
+        # Unknown events can't be resumed
+        resp = await self.client.get(
+            "/api/v1/events", headers={"Last-Event-ID": "unknown-1"}
+        )
+        assert (await read_event(resp))["event"] == "reset"
+        resp.close()
+
+    def test_feed_generations(self):
+        events = ChangeFeed()
+        events.sync(1)
+
+        # A local commit not published yet is not mistaken for another process
+        with mock.patch.object(feed, "SYNC_INTERVAL", 0):
+            events.sync(2)
+            events.publish("note-created", {}, generation=2)
+            events.sync(2)
+
+            # Commits of other processes in between local ones are detected
+            events.publish("note-updated", {}, generation=4)
+
+            # As well as those staying unpublished
+            events.sync(5)
+            events.sync(5)
+
+        assert [_.type for _ in events._events] == [
+            "note-created",
+            "reset",
+            "note-updated",
+            "reset",
+        ]
+
+    @unittest_run_loop
+    async def test_assets(self):
+        config = configuration.load(CONFIG_CNF)
+        static_dir = config["service"]["static-dir"]
+
+        with tempfile.TemporaryDirectory() as assets_dir:
+            manifest = assets.build(static_dir, assets_dir)
+            versioned = manifest["js/noteandtag.js"]
+            assert versioned != "js/noteandtag.js"
+
+            app = Application(
+                db=self.db_path,
+                jinja2_templates_dir=config["service"]["jinja2-templates-dir"],
+                cdn_url=config["service"]["cdn-url"],
+                assets_dir=assets_dir,
+                default_theme=config["service"]["default-theme"],
+            )
+            async with TestClient(TestServer(app)) as client:
+                # Index page links to versioned files
+                resp = await client.get("/")
+                assert f"/static/{versioned}" in await resp.text()
+
+                # Served compressed and cached forever
+                resp = await client.get(
+                    f"/static/{versioned}", headers={"Accept-Encoding": "gzip"}
+                )
+                assert resp.status == 200
+                assert resp.headers["Content-Encoding"] == "gzip"
+                assert "immutable" in resp.headers["Cache-Control"]
+                with open(os.path.join(static_dir, "js", "noteandtag.js"), "rb") as f:
+                    assert await resp.read() == f.read()
+
+                # Unversioned names are revalidated
+                resp = await client.get("/static/js/noteandtag.js")
+                assert resp.status == 200
+                assert resp.headers["Cache-Control"] == "no-cache"
+
+                resp = await client.get(f"/static/{assets.MANIFEST}")
+                assert resp.status == 404
+
+    @unittest_run_loop
+    async def test_query_count(self):
+        self._clean_db()
+
+        ids = []
+        for i in range(20):
+            new_note = await self._add_note(
+                note(label="test", author="test", body="test", tags=["a", "b"])
+            )
+            ids.append(new_note["id"])
+
+        # Count statements sent to SQLite
+        lock = threading.Lock()
+        count = 0
+        execute = monad._CursorContext._execute
+
+        def counting_execute(*args, **kwargs):
+            nonlocal count
+            with lock:
+                count += 1
+            return execute(*args, **kwargs)
+
+        with mock.patch.object(monad._CursorContext, "_execute", counting_execute):
+            # ETag + count + page + tags
+            notes = await self._get_notes(params={"tags": "a", "limit": 20})
+            assert len(notes) == 20
+            assert count == 4
+
+            # ETag + notes + tags, in the requested order
+            count = 0
+            ids = list(reversed(ids))
+            notes = await self._get_notes(params={"ids": ",".join(map(str, ids))})
+            assert [_["id"] for _ in notes] == ids
+            assert all(sorted(_["tags"]) == ["a", "b"] for _ in notes)
+            assert count == 3
+
+    @unittest_run_loop
+    async def test_import_export(self):
+        self._clean_db()
+
+        lines = [
+            json.dumps(note(id=i + 1, label=f"n{i}", tags=["a", f"t{i}"]))
+            for i in range(10)
+        ]
+        resp = await self.client.post(
+            "/api/v1/notes/import", data="\n".join(lines) + "\n"
+        )
+        assert resp.status == 200
+        assert json.loads(await resp.read())["imported"] == 10
+
+        # Existing ids are rejected
+        resp = await self.client.post("/api/v1/notes/import", data=lines[0])
+        assert resp.status == 400
+
+        # Invalid notes are rejected
+        resp = await self.client.post("/api/v1/notes/import", data='{"id": 20}')
+        assert resp.status == 400
+        assert "line 1" in json.loads(await resp.read())["error_description"]
+
+        resp = await self.client.get("/api/v1/notes/export")
+        assert resp.status == 200
+        notes = [json.loads(_) for _ in (await resp.text()).splitlines()]
+        assert notes == [json.loads(_) for _ in lines]
+
     """This will clear all notes from test DB.
     """
 
@@ -124,7 +1085,9 @@ class ServiceTestCase(AioHTTPTestCase):
     async def _add_note(self, note, *, status=200):
         resp = await self.client.put("/api/v1/notes", data=json.dumps({"data": note}))
         assert resp.status == status
-        return json.loads(await resp.read())
+        if resp.status == 200:
+            return json.loads(await resp.read())
+        return None
 
     """Send GET request to get a note by id.
     """